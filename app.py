@@ -1,19 +1,25 @@
 import os
-from flask import Flask, request, g, redirect, url_for, send_from_directory, flash, render_template, session, abort
+from flask import Flask, request, g, redirect, url_for, send_from_directory, flash, render_template, session, abort, \
+	Response, stream_with_context
 from flask_github import GitHub
 from werkzeug.utils import secure_filename
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
 from functools import wraps
 import base64
 import hashlib
 import random
+import tempfile
 import json
+import threading
+import time
+from collections import OrderedDict
 
 import deployer
+import locks
+import monitor
+import ratelimit
 import dev_config as config
 
+from models import db_session, init_db, User
 from naming import normalize_username, get_bot_name
 
 app = Flask(__name__)
@@ -22,31 +28,9 @@ app.config.from_object(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 app.config['GITHUB_CLIENT_ID'] = config.GITHUB_CLIENT_ID
 app.config['GITHUB_CLIENT_SECRET'] = config.GITHUB_CLIENT_SECRET
-app.config['DATABASE_URI'] = config.DATABASE_URI
 app.config['SECRET_KEY'] = config.SECRET_KEY
 app.config['DEBUG'] = config.DEBUG
 github = GitHub(app)
-engine = create_engine(app.config['DATABASE_URI'])
-db_session = scoped_session(sessionmaker(autocommit=False,
-										 autoflush=False,
-										 bind=engine))
-Base = declarative_base()
-Base.query = db_session.query_property()
-
-
-def init_db():
-	Base.metadata.create_all(bind=engine)
-
-class User(Base):
-	__tablename__ = 'users'
-
-	id = Column(Integer, primary_key=True)
-	username = Column(String(200))
-	github_access_token = Column(String(200))
-	api_key = Column(String(200))
-
-	def __init__(self, github_access_token):
-		self.github_access_token = github_access_token
 
 def allowed_file(name):
 	return os.path.splitext(name)[1] in config.ALLOWED_EXTENSIONS
@@ -67,13 +51,31 @@ def apikey_check(view_function):
 			if not users.count() == 1:
 				return abort(401)
 			g.user = users[0]
-			return view_function(*args, **kwargs)
+			return rate_limited(view_function, ratelimit.get_user_key(g.user.id), *args, **kwargs)
 		else:
 			abort(401)
 	return decorated_function
 
-import deployer
-import dev_config as config
+def rate_limited(view_function, key, *args, **kwargs):
+	endpoint = view_function.__name__
+	operation_id = None
+	if endpoint in config.CONCURRENCY_LIMITED_ENDPOINTS:
+		operation_id = ratelimit.limiter.acquire(key)
+		if operation_id is None:
+			return too_many_requests_response("Too many operations in progress.", 1)
+	try:
+		retry_after = ratelimit.limiter.consume(key, ratelimit.get_cost(endpoint))
+		if retry_after > 0:
+			return too_many_requests_response("Rate limit exceeded.", retry_after)
+		response = view_function(*args, **kwargs)
+		if operation_id is not None and isinstance(response, Response) and response.is_streamed:
+			# The operation only ends once the response has been streamed.
+			response.call_on_close(lambda: ratelimit.limiter.release(operation_id))
+			operation_id = None
+		return response
+	finally:
+		if operation_id is not None:
+			ratelimit.limiter.release(operation_id)
 
 @app.after_request
 def after_request(response):
@@ -115,7 +117,17 @@ def upload_file():
 		name, file_ext = os.path.splitext(file.filename)
 		bot_name = get_bot_name(username, name)
 		bot_filename = bot_name + file_ext
-		file.save(os.path.join(deployer.get_bots_dir(), bot_filename))
+		# Save to a temporary file first, so that processing the bot never
+		# reads a partially written archive.
+		fd, temp_path = tempfile.mkstemp(dir=deployer.get_bots_dir(), prefix='.upload-')
+		try:
+			with os.fdopen(fd, 'wb') as temp_file:
+				file.save(temp_file)
+			with deployer.bot_lock(bot_name, 'upload'):
+				os.replace(temp_path, os.path.join(deployer.get_bots_dir(), bot_filename))
+		except BaseException:
+			os.remove(temp_path)
+			raise
 		return success_response(message="Bot uploaded successfully. Now you need to process it.")
 
 @app.route('/uploads/<filename>')
@@ -137,6 +149,8 @@ def authorized(access_token):
 		user = User(access_token)
 		db_session.add(user)
 	user.github_access_token = access_token
+	# Tells apart the owners of bots that predate the bot catalog.
+	user.username = github.get('user', access_token=access_token).get('login')
 	if not user.api_key:
 		user.api_key = generate_hash_key()
 	db_session.commit()
@@ -164,6 +178,20 @@ def user():
 def user_api_key():
 	return g.user.api_key
 
+@app.route('/user/zulip', methods=['POST'])
+@apikey_check
+def do_set_zulip_email():
+	# The email is only linked once its owner sends this token to the
+	# ingest bot, since Zulip authenticates the sender of a message.
+	g.user.zulip_link_token = os.urandom(16).hex()
+	# Bots uploaded from Zulip are named after the user's GitHub login.
+	g.user.username = github.get('user').get('login')
+	db_session.commit()
+	return success_response(
+		token=g.user.zulip_link_token,
+		message="Send 'link {}' in a private message to the bot uploads are sent to.".format(
+			g.user.zulip_link_token))
+
 @app.route('/bots/process', methods=['POST'])
 @apikey_check
 def do_process_bot():
@@ -172,14 +200,48 @@ def do_process_bot():
 		return error_response("Specify a bot name.")
 	username = github.get('user').get('login')
 	bot_name = get_bot_name(username, data.get('name'))
-	extracted = deployer.extract_file(bot_name)
-	if not extracted:
-		return error_response("Failure. Bot zip file not found.")
-	if not deployer.check_and_load_structure(bot_name):
-		return error_response("Failure. Something's wrong with your zip file.")
-	deployer.create_docker_image(bot_name)
+	owner = normalize_username(username)
+	if data.get('stream', False):
+		# Stream the build output as plain text, line by line.
+		return Response(stream_with_context(stream_process_bot(bot_name, owner)), mimetype='text/plain')
+	# Hold the bot's lock across all steps so that concurrent requests
+	# can't extract over a bot that is being built.
+	with deployer.bot_lock(bot_name, 'process'):
+		extracted = deployer.extract_file(bot_name, owner)
+		if not extracted:
+			return error_response("Failure. Bot zip file not found.")
+		if not deployer.check_and_load_structure(bot_name):
+			return error_response("Failure. Something's wrong with your zip file.")
+		try:
+			deployer.create_docker_image(bot_name)
+		except deployer.BuildError as e:
+			return error_response("Failure. Build failed: " + str(e))
 	return success_response()
 
+def stream_process_bot(bot_name, owner):
+	# Runs after the request has been torn down, so it cleans up its own
+	# database session, also when the client disconnects.
+	try:
+		with deployer.bot_lock(bot_name, 'process'):
+			if not deployer.extract_file(bot_name, owner):
+				yield "Failure. Bot zip file not found.\n"
+				return
+			if not deployer.check_and_load_structure(bot_name):
+				yield "Failure. Something's wrong with your zip file.\n"
+				return
+			builder = deployer.stream_docker_image_build(bot_name)
+			try:
+				for line in builder:
+					yield line
+			except deployer.BuildError as e:
+				yield "Failure. Build failed: " + str(e) + "\n"
+				return
+			finally:
+				builder.close()
+		yield "Success.\n"
+	finally:
+		db_session.remove()
+
 @app.route('/bots/start', methods=['POST'])
 @apikey_check
 def do_start_bot():
@@ -211,8 +273,19 @@ def do_get_log(botname, **kwargs):
 		return error_response("Specify a bot name.")
 	username = github.get('user').get('login')
 	bot_name = get_bot_name(username, data.get('name'))
+	version = deployer.get_bot_log_version(bot_name)
+	if version is not None:
+		etag = make_etag('logs', bot_name, lines, version)
+		response = conditional_response(etag)
+		if response is not None:
+			return response
 	logs = deployer.bot_log(bot_name, lines=lines)
-	return success_response(logs=dict(content=logs))
+	if version is None:
+		# The bot is running, so its logs have to be read to version them.
+		etag = make_etag('logs', bot_name, lines, hashlib.sha1(logs.encode('utf-8')).hexdigest())
+		if request.if_none_match.contains(etag):
+			return not_modified_response(etag)
+	return etag_response(success_response(logs=dict(content=logs)), etag, cache=version is not None)
 
 @app.route('/bots/delete', methods=['POST'])
 @apikey_check
@@ -222,7 +295,7 @@ def do_delete_bot():
 		return error_response("Specify a bot name")
 	username = github.get('user').get('login')
 	bot_name = get_bot_name(username, data.get('name'))
-	if not deployer.delete_bot(bot_name):
+	if not deployer.delete_bot(bot_name, normalize_username(username)):
 		return error_response()
 	return success_response()
 
@@ -230,8 +303,80 @@ def do_delete_bot():
 @apikey_check
 def do_list_bots():
 	username = normalize_username(github.get('user').get('login'))
+	etag = make_etag('list', username, deployer.get_user_bots_version(username))
+	response = conditional_response(etag)
+	if response is not None:
+		return response
 	bots = deployer.get_user_bots(username)
-	return success_response(bots=dict(list=bots))
+	return etag_response(success_response(bots=dict(list=bots)), etag)
+
+@app.route('/bots/builds', methods=['GET'])
+@apikey_check
+def do_get_build_report():
+	username = normalize_username(github.get('user').get('login'))
+	report = deployer.get_build_report(username)
+	return success_response(builds=dict(list=report))
+
+@app.route('/bots/builds/<botname>/log', methods=['GET'])
+@apikey_check
+def do_get_build_log(botname):
+	username = github.get('user').get('login')
+	build_log = deployer.get_build_log(get_bot_name(username, botname))
+	if build_log is None:
+		return error_response("No build log found.")
+	return success_response(build_log=dict(content=build_log))
+
+@app.route('/bots/stats', methods=['GET'])
+@apikey_check
+def do_get_bot_stats():
+	username = normalize_username(github.get('user').get('login'))
+	bot_name_prefix = get_bot_name(username, '')
+	# Only reads what the sampler stored; never waits on the Docker daemon.
+	bot_usage = monitor.get_bot_usage(username)
+	active_since = time.time() - 2 * config.STATS_SAMPLE_INTERVAL
+	bots = [dict(name=bot_name[len(bot_name_prefix):], **usage)
+			for bot_name, usage in bot_usage.items()]
+	return success_response(stats=dict(bots=bots, user=monitor.summarize_usage(bot_usage, active_since)))
+
+@app.route('/metrics/locks', methods=['GET'])
+@apikey_check
+def do_get_lock_metrics():
+	# Metrics are collected per worker process.
+	return success_response(locks=locks.metrics.get())
+
+# Serialized responses by ETag. An ETag is derived from the version of
+# the state a response was built from, so cached bodies never go stale.
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+
+def make_etag(*parts):
+	return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def conditional_response(etag):
+	if request.if_none_match.contains(etag):
+		return not_modified_response(etag)
+	with response_cache_lock:
+		body = response_cache.get(etag)
+		if body is not None:
+			response_cache.move_to_end(etag)
+	if body is not None:
+		return etag_response(body, etag, cache=False)
+	return None
+
+def not_modified_response(etag):
+	response = app.response_class(status=304)
+	response.set_etag(etag)
+	return response
+
+def etag_response(body, etag, cache=True):
+	if cache:
+		with response_cache_lock:
+			response_cache[etag] = body
+			while len(response_cache) > config.RESPONSE_CACHE_SIZE:
+				response_cache.popitem(last=False)
+	response = app.make_response(body)
+	response.set_etag(etag)
+	return response
 
 def success_response(message='', **payload):
 	return json.dumps(dict(status="success", message=message, **payload))
@@ -239,6 +384,9 @@ def success_response(message='', **payload):
 def error_response(message=''):
 	return json.dumps(dict(status="error", message=message))
 
+def too_many_requests_response(message, retry_after):
+	return error_response(message), 429, {'Retry-After': ratelimit.retry_after_header(retry_after)}
+
 if __name__ == '__main__':
 	init_db()
 	app.run(debug=True)
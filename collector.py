@@ -0,0 +1,275 @@
+# Background garbage collection of orphaned bot containers, images and files.
+#
+# API deletes only stop a bot and mark it as deleted in the catalog, and
+# rebuilds leave the previous build behind. The collector runs as its own
+# process (`tools/collect-garbage --loop`), periodically finds everything
+# that is no longer needed and removes it concurrently, in batches and at a
+# throttled rate, so the Docker daemon stays responsive for API requests.
+#
+# Orphans are:
+#   - containers and images of deleted bots,
+#   - stopped containers of a bot other than its current one,
+#   - untagged images of a bot, left behind when it was rebuilt,
+#   - bot archives and directories of deleted bots, and extracted bot
+#     directories of unknown bots whose archive was removed.
+# Artifacts of bots that predate the catalog are otherwise left alone.
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from docker.errors import DockerException, NotFound
+
+import deployer
+import dev_config as config
+from locks import bot_lock
+from models import db_session, Bot, BotUsage, Build
+from naming import BOT_IMAGE_PREFIX, BOT_LABEL, extract_bot_name_from_image
+
+REASON_BOT_DELETED = 'bot deleted'
+REASON_STALE_CONTAINER = 'stale container'
+REASON_DANGLING_IMAGE = 'dangling image'
+REASON_ARCHIVE_REMOVED = 'archive removed'
+
+class Orphan:
+    def __init__(self, kind: str, bot_name: str, target: Any, name: str, reason: str):
+        self.kind = kind  # 'container', 'image' or 'path'
+        self.bot_name = bot_name
+        self.target = target
+        self.name = name
+        self.reason = reason
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(kind=self.kind, bot=self.bot_name, name=self.name, reason=self.reason)
+
+class Throttle:
+    """Spaces out calls to `wait` to at most `rate` per second, across threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next)
+            self._next = scheduled + self.interval
+        time.sleep(scheduled - now)
+
+def _bot_name_from_tags(tags: List[str]) -> Optional[str]:
+    for tag in tags:
+        if tag.startswith(BOT_IMAGE_PREFIX):
+            return extract_bot_name_from_image(tag.split(':')[0])
+    return None
+
+def _is_deleted(bot: Optional[Bot]) -> bool:
+    return bot is not None and bot.status == 'deleted'
+
+def _modified_before(path: str, moment: datetime) -> bool:
+    return datetime.utcfromtimestamp(os.path.getmtime(path)) <= moment
+
+class GarbageCollector:
+    def __init__(self,
+                 interval: float = config.GC_INTERVAL,
+                 batch_size: int = config.GC_BATCH_SIZE,
+                 workers: int = config.GC_WORKERS,
+                 max_removals_per_second: float = config.GC_MAX_REMOVALS_PER_SECOND):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.workers = workers
+        self.throttle = Throttle(max_removals_per_second)
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                report = self.collect()
+                if report['removed'] or report['errors']:
+                    print(json.dumps(report))
+            except Exception as e:
+                print("Garbage collection failed: " + str(e))
+            finally:
+                db_session.remove()
+            self._stopped.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def find_orphans(self) -> List[Orphan]:
+        bots = {bot.name: bot for bot in Bot.query}
+        docker_client = deployer.get_docker_client()
+        orphans = []
+
+        images = docker_client.images.list()
+        images_by_id = {image.id: image for image in images}
+        for image in images:
+            bot_name = image.labels.get(BOT_LABEL) or _bot_name_from_tags(image.tags)
+            if bot_name is None:
+                continue
+            reason = None
+            if _is_deleted(bots.get(bot_name)):
+                reason = REASON_BOT_DELETED
+            elif not image.tags:
+                reason = REASON_DANGLING_IMAGE
+            if reason is not None:
+                orphans.append(Orphan('image', bot_name, image, image.short_id, reason))
+
+        for container in docker_client.containers.list(all=True):
+            bot_name = container.labels.get(BOT_LABEL)
+            if bot_name is None:
+                # Containers started before they were labelled
+                image = images_by_id.get(container.attrs.get('Image'))
+                bot_name = _bot_name_from_tags(image.tags) if image is not None else None
+            bot = bots.get(bot_name)
+            if bot is None:
+                continue
+            reason = None
+            if _is_deleted(bot):
+                reason = REASON_BOT_DELETED
+            elif container.status != 'running' and container.id != bot.container_id:
+                reason = REASON_STALE_CONTAINER
+            if reason is not None:
+                orphans.append(Orphan('container', bot_name, container, container.short_id, reason))
+
+        bots_dir = deployer.get_bots_dir()
+        entries = [entry for entry in os.scandir(bots_dir) if not entry.name.startswith('.')]
+        archive_names = set()
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if entry.is_file() and ext in config.ALLOWED_EXTENSIONS:
+                archive_names.add(name)
+        for entry in entries:
+            if entry.is_dir():
+                bot_name = entry.name
+            elif entry.is_file() and os.path.splitext(entry.name)[1] in config.ALLOWED_EXTENSIONS:
+                bot_name = os.path.splitext(entry.name)[0]
+            else:
+                continue
+            bot = bots.get(bot_name)
+            reason = None
+            if _is_deleted(bot):
+                # Keep anything uploaded again after the bot was deleted.
+                if _modified_before(entry.path, bot.updated_at):
+                    reason = REASON_BOT_DELETED
+            elif bot is None and entry.is_dir() and bot_name not in archive_names:
+                reason = REASON_ARCHIVE_REMOVED
+            if reason is not None:
+                orphans.append(Orphan('path', bot_name, entry.path, entry.name, reason))
+
+        return orphans
+
+    def collect(self, dry_run: bool = False) -> Dict[str, Any]:
+        orphans = self.find_orphans()
+        deleted_bots = sorted(bot.name for bot in Bot.query.filter_by(status='deleted'))
+        report = dict(
+            dry_run=dry_run,
+            orphans=[orphan.to_dict() for orphan in orphans],
+            deleted_bots=deleted_bots,
+            removed=0,
+            errors=[],
+        )
+        if dry_run:
+            return report
+
+        orphans_by_bot = {bot_name: [] for bot_name in deleted_bots}
+        for orphan in orphans:
+            orphans_by_bot.setdefault(orphan.bot_name, []).append(orphan)
+        bot_names = sorted(orphans_by_bot.keys())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for i in range(0, len(bot_names), self.batch_size):
+                batch = bot_names[i:i + self.batch_size]
+                results = executor.map(lambda bot_name: self._collect_bot(bot_name, orphans_by_bot[bot_name]),
+                                       batch)
+                for removed, errors in results:
+                    report['removed'] += removed
+                    report['errors'].extend(errors)
+        return report
+
+    def _collect_bot(self, bot_name: str, orphans: List[Orphan]):
+        removed = 0
+        errors = []
+        try:
+            with bot_lock(bot_name, 'collect'):
+                # The bot may have changed since the orphans were found.
+                bot = Bot.query.filter_by(name=bot_name).first()
+                # Containers have to go before the images they were created from.
+                kind_order = dict(container=0, image=1, path=2)
+                for orphan in sorted(orphans, key=lambda orphan: kind_order[orphan.kind]):
+                    if not self._is_still_orphaned(orphan, bot):
+                        continue
+                    self.throttle.wait()
+                    try:
+                        self._remove(orphan)
+                        removed += 1
+                    except (DockerException, OSError) as e:
+                        errors.append(dict(error=str(e), **orphan.to_dict()))
+                if _is_deleted(bot) and not errors:
+                    Build.query.filter_by(bot_name=bot_name).delete()
+                    BotUsage.query.filter_by(bot_name=bot_name).delete()
+                    Bot.query.filter_by(name=bot_name, status='deleted').delete()
+                    deployer.bump_catalog_version(bot.owner)
+                    db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            errors.append(dict(bot=bot_name, error=str(e)))
+        finally:
+            db_session.remove()
+        return removed, errors
+
+    def _is_still_orphaned(self, orphan: Orphan, bot: Optional[Bot]) -> bool:
+        if orphan.reason == REASON_BOT_DELETED:
+            if orphan.kind == 'path':
+                return (_is_deleted(bot) and os.path.exists(orphan.target) and
+                        _modified_before(orphan.target, bot.updated_at))
+            return _is_deleted(bot)
+        if orphan.reason == REASON_STALE_CONTAINER:
+            return bot is not None and orphan.target.id != bot.container_id
+        if orphan.reason == REASON_ARCHIVE_REMOVED:
+            return bot is None and deployer.find_bot_file(orphan.bot_name) is None
+        return True
+
+    def _remove(self, orphan: Orphan) -> None:
+        if orphan.kind == 'container':
+            try:
+                orphan.target.remove(v=True, force=True)
+            except NotFound:
+                pass
+            print("Bot container was removed.")
+        elif orphan.kind == 'image':
+            try:
+                deployer.get_docker_client().images.remove(image=orphan.target.id, force=True)
+            except NotFound:
+                pass
+            print("Bot image was removed.")
+        elif os.path.isdir(orphan.target):
+            shutil.rmtree(orphan.target)
+            print("Bot dir was removed.")
+        elif os.path.exists(orphan.target):
+            os.remove(orphan.target)
+            print("Bot zip file was removed.")
+
+collector = GarbageCollector()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Remove orphaned bot containers, images and files.')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='only report what would be removed')
+    parser.add_argument('--loop',
+                        action='store_true',
+                        help='keep collecting every GC_INTERVAL seconds')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = parse_args()
+    if options.loop:
+        collector.run()
+    else:
+        print(json.dumps(collector.collect(dry_run=options.dry_run), indent=2))
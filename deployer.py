@@ -1,18 +1,26 @@
 # See readme.md for instructions on running this code.
 
 from typing import Any
-from urllib.parse import urlparse
-import requests
 import zipfile
 import textwrap
 import configparser
 import os
-import shutil
+import re
+import json
+import time
+import hashlib
+import threading
 from pathlib import Path
 import docker
+import requests
+from docker.errors import DockerException, NotFound
 from datetime import datetime
-from naming import get_bot_image_name, get_bot_name, \
-    extract_bot_name_from_image
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import SQLAlchemyError
+from models import db_session, init_db, Bot, Build, CatalogVersion, User
+from locks import bot_lock, locked
+from naming import get_bot_image_name, get_bot_name, normalize_username, \
+    extract_bot_name_from_image, BOT_LABEL
 import dev_config as config
 
 BOTS_DIR = config.UPLOAD_FOLDER
@@ -31,8 +39,43 @@ CONTAINER_STATUS_PRIORITY = {
     'running': CONTAINER_STATUS_HIGH_PRIORITY,
 }
 
+BUILD_LOG_FILE = 'build.txt'
+BUILD_STEP_PATTERN = re.compile(r'^Step \d+/\d+ : (.*)$')
+BUILD_SUCCESS_PATTERN = re.compile(r'^Successfully built ([0-9a-f]+)$')
+
+BUILD_STAGE_CONTEXT = 'context'
+BUILD_STAGE_BASE_PULL = 'base_pull'
+BUILD_STAGE_BASE_INSTALL = 'base_install'
+BUILD_STAGE_SOURCE_ADD = 'source_add'
+BUILD_STAGE_PIP_INSTALL = 'pip_install'
+BUILD_STAGE_OTHER = 'other'
+
 provision = False
-docker_client = docker.from_env()
+
+# Created on first use, so that importing this module doesn't need a
+# running Docker daemon. Use get_docker_client() to access it.
+docker_client = None
+_docker_client_checked_at = 0.0
+_docker_client_lock = threading.Lock()
+
+def get_docker_client():
+    global docker_client, _docker_client_checked_at
+    client = docker_client
+    if client is not None and time.monotonic() - _docker_client_checked_at < config.DOCKER_HEALTH_CHECK_INTERVAL:
+        return client
+    with _docker_client_lock:
+        if docker_client is not None:
+            try:
+                docker_client.ping()
+                _docker_client_checked_at = time.monotonic()
+                return docker_client
+            except (DockerException, requests.RequestException) as e:
+                print("Lost connection to the Docker daemon, reconnecting: " + str(e))
+                docker_client.close()
+                docker_client = None
+        docker_client = docker.from_env(max_pool_size=config.DOCKER_POOL_SIZE)
+        _docker_client_checked_at = time.monotonic()
+        return docker_client
 
 def read_config_item(config_file, config_item):
     if not Path(config_file).is_file:
@@ -68,31 +111,8 @@ def find_bot_file(bot_name):
 				return filepath
 	return None
 
-def is_new_bot_message(message):
-    msg = message['content']
-    name = msg[msg.find("[")+1:msg.rfind("]")]
-    url = msg[msg.find("(")+1:msg.rfind(")")]
-    sender = message['sender_email']
-    if name.endswith('.zip') and url.startswith('/user_uploads/'):
-        file_name = sender + '-' + name
-        url = url
-        return True
-    return False
-
-def set_details_up(data):
-    name = data['name']
-    sender = data['sender']
-    message = data['message']
-    url = data['url']
-
-def download_file(base_url):
-    parsed_uri = urlparse(base_url)
-    file_url = '{uri.scheme}://{uri.netloc}'.format(uri=parsed_uri)
-    file_url = file_url + url
-    r = requests.get(file_url, allow_redirects=True)
-    open('bots/' + file_name, 'wb').write(r.content)
-
-def extract_file(bot_name):
+@locked('extract')
+def extract_file(bot_name, owner):
     bot_zip_path = find_bot_file(bot_name)
     if bot_zip_path is None:
         return False
@@ -100,8 +120,20 @@ def extract_file(bot_name):
     bot_root = get_bot_root(bot_name)
     bot_zip.extractall(bot_root)
     bot_zip.close()
+    fields = dict(archive_hash=_hash_file(bot_zip_path))
+    # The old version keeps running until a build replaces it.
+    if not _is_running(bot_name):
+        fields.update(status='extracted')
+    _update_bot_record(bot_name, owner=owner, **fields)
     return True
 
+def _hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
 def check_and_load_structure(bot_name):
     bot_root = get_bot_root(bot_name)
     config = get_config(bot_root)
@@ -117,69 +149,208 @@ def check_and_load_structure(bot_name):
         print("Found a requirements file")
     return True
 
+class BuildError(Exception):
+    def __init__(self, msg):
+        super(BuildError, self).__init__(msg)
+
+def get_build_stage(instruction):
+    if instruction.startswith('FROM'):
+        return BUILD_STAGE_BASE_PULL
+    if instruction.startswith('RUN pip install -r'):
+        return BUILD_STAGE_PIP_INSTALL
+    if instruction.startswith('RUN pip install'):
+        return BUILD_STAGE_BASE_INSTALL
+    if instruction.startswith('ADD') or instruction.startswith('COPY'):
+        return BUILD_STAGE_SOURCE_ADD
+    return BUILD_STAGE_OTHER
+
+class BuildTimer:
+    """Adds up the time spent in each build stage from the build output."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.stages = dict()
+        # Before the first step, the daemon is receiving the build context.
+        self._stage = BUILD_STAGE_CONTEXT
+        self._stage_started = self.started
+
+    def feed(self, line):
+        match = BUILD_STEP_PATTERN.match(line.strip())
+        if match is not None:
+            self._finish_stage()
+            self._stage = get_build_stage(match.group(1))
+            self._stage_started = self.clock()
+
+    def finish(self):
+        self._finish_stage()
+        self._stage = None
+        return self.clock() - self.started
+
+    def _finish_stage(self):
+        if self._stage is not None:
+            elapsed = self.clock() - self._stage_started
+            self.stages[self._stage] = self.stages.get(self._stage, 0.0) + elapsed
+
 def create_docker_image(bot_name):
-    bot_root = get_bot_root(bot_name)
-    config = get_config(bot_root)
-    dockerfile = textwrap.dedent('''\
-        FROM python:3
-        RUN pip install zulip zulip-bots zulip-botserver
-        ADD ./* bot/
-        RUN pip install -r bot/requirements.txt
-        ''')
-    dockerfile += 'CMD [ "zulip-run-bot", "bot/{bot}", "-c", "bot/{zuliprc}" ]\n'.format(bot=config['bot'], zuliprc=config['zuliprc'])
-    with open(os.path.join(bot_root, 'Dockerfile'), "w") as file:
-        file.write(dockerfile)
-    _delete_bot_images(bot_name)
-    bot_image_name = get_bot_image_name(bot_name)
-    bot_image = docker_client.images.build(path=bot_root, tag=bot_image_name)
+    for line in stream_docker_image_build(bot_name):
+        pass
 
+def stream_docker_image_build(bot_name):
+    """Build the bot's image, yielding the build output line by line.
+
+    The output is also written to the bot's build log, and the time spent
+    in each build stage is recorded for the build time report."""
+    with bot_lock(bot_name, 'build'):
+        bot_root = get_bot_root(bot_name)
+        config = get_config(bot_root)
+        dockerfile = textwrap.dedent('''\
+            FROM python:3
+            RUN pip install zulip zulip-bots zulip-botserver
+            ADD ./* bot/
+            RUN pip install -r bot/requirements.txt
+            ''')
+        dockerfile += 'LABEL {label}="{bot_name}"\n'.format(label=BOT_LABEL, bot_name=bot_name)
+        dockerfile += 'CMD [ "zulip-run-bot", "bot/{bot}", "-c", "bot/{zuliprc}" ]\n'.format(bot=config['bot'], zuliprc=config['zuliprc'])
+        with open(os.path.join(bot_root, 'Dockerfile'), "w") as file:
+            file.write(dockerfile)
+        with open(os.path.join(bot_root, '.dockerignore'), "w") as file:
+            file.write(BUILD_LOG_FILE + '\n')
+        # The containers and image of the previous build are left to the
+        # garbage collector; only make sure the old version stops running.
+        _stop_bot_containers(bot_name)
+        if _is_running(bot_name):
+            _update_bot_record(bot_name, container_id=None, status='extracted')
+        bot_image_name = get_bot_image_name(bot_name)
+        build = Build(bot_name)
+        timer = BuildTimer()
+        image_id = None
+        error = None
+        try:
+            with open(os.path.join(bot_root, BUILD_LOG_FILE), "w") as build_log:
+                output = get_docker_client().api.build(path=bot_root, tag=bot_image_name, rm=True, decode=True)
+                try:
+                    for chunk in output:
+                        if 'aux' in chunk:
+                            image_id = chunk['aux'].get('ID', image_id)
+                        if 'error' in chunk:
+                            error = chunk['error'].strip()
+                        text = chunk.get('stream', chunk.get('error', ''))
+                        for line in text.splitlines(keepends=True):
+                            timer.feed(line)
+                            match = BUILD_SUCCESS_PATTERN.match(line.strip())
+                            if match is not None and image_id is None:
+                                image_id = match.group(1)
+                            build_log.write(line)
+                            build_log.flush()
+                            yield line
+                finally:
+                    # Stop reading the build output as soon as the
+                    # client streaming it goes away.
+                    output.close()
+        finally:
+            _record_build(build, timer.finish(), image_id is not None and error is None, timer.stages)
+        if error is not None or image_id is None:
+            raise BuildError(error or "Build did not produce an image.")
+        zuliprc = _read_bot_zuliprc(bot_name)
+        _update_bot_record(bot_name, image_id=image_id, container_id=None, status='built',
+                           email=zuliprc['email'], site=zuliprc['site'])
+
+def _record_build(build, duration, success, stages):
+    build.duration = duration
+    build.success = success
+    build.stages = json.dumps(stages)
+    try:
+        db_session.add(build)
+        db_session.flush()
+        # Only keep the latest builds of each bot.
+        old_builds = Build.query.filter_by(bot_name=build.bot_name) \
+            .order_by(Build.id.desc()).offset(config.BUILD_HISTORY_SIZE)
+        for old_build in old_builds:
+            db_session.delete(old_build)
+        db_session.commit()
+    except SQLAlchemyError:
+        db_session.rollback()
+        raise
+
+def get_build_log(bot_name):
+    build_log_path = os.path.join(get_bot_root(bot_name), BUILD_LOG_FILE)
+    if not os.path.isfile(build_log_path):
+        return None
+    with open(build_log_path) as build_log:
+        return build_log.read()
+
+def get_build_report(owner):
+    # Bot names alone can't tell apart the bots of 'john' and 'john-doe'.
+    bot_name_prefix = get_bot_name(owner, '')
+    builds_by_bot = dict()
+    for build in Build.query.join(Bot, Bot.name == Build.bot_name).filter(Bot.owner == owner):
+        builds_by_bot.setdefault(build.bot_name, []).append(build)
+    report = []
+    for bot_name, builds in builds_by_bot.items():
+        successful_builds = [build for build in builds if build.success]
+        stages = dict()
+        for build in successful_builds:
+            for stage, seconds in json.loads(build.stages).items():
+                stages[stage] = stages.get(stage, 0.0) + seconds / len(successful_builds)
+        report.append(dict(
+            name=bot_name[len(bot_name_prefix):],
+            builds=len(builds),
+            failures=len(builds) - len(successful_builds),
+            duration=(sum(build.duration for build in successful_builds) / len(successful_builds)
+                      if successful_builds else None),
+            stages=stages,
+        ))
+    # Bots whose own dependencies take longest to install come first.
+    report.sort(key=lambda bot: (bot['stages'].get(BUILD_STAGE_PIP_INSTALL, 0.0), bot['duration'] or 0.0),
+                reverse=True)
+    return report
+
+@locked('start')
 def start_bot(bot_name):
+    if _is_deleted(bot_name):
+        return False
     bot_image_name = get_bot_image_name(bot_name)
-    containers = docker_client.containers.list()
+    containers = get_docker_client().containers.list()
     for container in containers:
         for tag in container.image.tags:
             if tag.startswith(bot_image_name):
                 # Bot already running
                 return False
-    container = docker_client.containers.run(bot_image_name, detach=True)
+    container = get_docker_client().containers.run(bot_image_name, detach=True,
+                                             labels={BOT_LABEL: bot_name})
+    _update_bot_record(bot_name, container_id=container.id, status='running')
     return True
 
+@locked('stop')
 def stop_bot(bot_name):
     bot_image_name = get_bot_image_name(bot_name)
-    containers = docker_client.containers.list()
+    containers = get_docker_client().containers.list()
     for container in containers:
         for tag in container.image.tags:
             if tag.startswith(bot_image_name):
                 _stop_bot_container(bot_name, container)
+                _update_bot_record(bot_name, status='exited')
                 return True
     return False
 
-def delete_bot(bot_name):
-    _delete_bot_images(bot_name)
-    _delete_bot_files(bot_name)
+@locked('delete')
+def delete_bot(bot_name, owner):
+    # Stop the bot right away and mark it as deleted; the garbage collector
+    # removes its containers, images and files in the background. Bots
+    # that predate the catalog get a record to mark.
+    _stop_bot_containers(bot_name)
+    _update_bot_record(bot_name, owner=owner, status='deleted')
     return True
 
-def _delete_bot_images(bot_name):
-    bot_containers = []
-    bot_image_ids = set()
+def _stop_bot_containers(bot_name):
     bot_image_name = get_bot_image_name(bot_name)
-    containers = docker_client.containers.list(all=True)
+    containers = get_docker_client().containers.list()
     for container in containers:
         for tag in container.image.tags:
             if tag.startswith(bot_image_name):
-                if container.status == 'running':
-                    _stop_bot_container(bot_name, container)
-                    # retrieve object for same container with updated status
-                    container = docker_client.containers.get(container.id)
-                bot_containers.append(container)
-                bot_image_ids.add(container.image.id)
-
-    for bot_container in bot_containers:
-        _delete_bot_container(bot_container)
-    
-    for bot_image_id in bot_image_ids:
-        _delete_bot_image(bot_image_id)
-
+                _stop_bot_container(bot_name, container)
+                break
 
 def _stop_bot_container(bot_name, container):
     logs = container.logs().decode("utf-8")
@@ -191,35 +362,12 @@ def _stop_bot_container(bot_name, container):
         logfile.write("--------------------\n")
     container.stop()
 
-def _delete_bot_container(container):
-    container.remove(v=True, force=True)
-    print("Bot container was removed.")
-
-def _delete_bot_image(image_id):
-    docker_client.images.remove(image=image_id, force=True)
-    print("Bot image was removed.")
-
-def _delete_bot_files(bot_name):
-    bot_root = get_bot_root(bot_name)
-    if Path(bot_root).is_dir():
-        shutil.rmtree(bot_root)
-        print("Bot dir was removed.")
-    else:
-        print("Bot dir not found.")
-    
-    bot_zip_file = find_bot_file(bot_name)
-    if bot_zip_file is not None:
-        os.remove(bot_zip_file)
-        print("Bot zip file was removed.")
-    else:
-        print("Bot zip file not found.")
-
 def bot_log(bot_name, **kwargs):
     lines = kwargs.get('lines', None)
     if lines is not None:
         lines = int(lines)
     bot_image_name = get_bot_image_name(bot_name)
-    containers = docker_client.containers.list(all=True)
+    containers = get_docker_client().containers.list(all=True)
     for container in containers:
         for tag in container.image.tags:
             if tag.startswith(bot_image_name):
@@ -233,31 +381,115 @@ def bot_log(bot_name, **kwargs):
                     return logs
     return 'No logs found.'
 
+def get_bot_log_version(bot_name):
+    # A bot's logs only change while it runs, so for any other bot the
+    # catalog state identifies its logs. Returns None when they may change.
+    bot = Bot.query.filter_by(name=bot_name).first()
+    if bot is None or bot.status == 'running':
+        return None
+    return '{}:{}:{}'.format(bot.container_id, bot.status, bot.version)
+
+def get_user_bots_version(username):
+    # The user's list also shows the bots without an owner.
+    return '{}:{}'.format(_get_catalog_version(username), _get_catalog_version(None))
+
+def _get_catalog_version(owner):
+    version = db_session.query(CatalogVersion.version).filter_by(owner=owner or '').scalar()
+    return version or 0
+
+def bump_catalog_version(owner):
+    """Increment and return the catalog version of `owner`, within the
+    caller's transaction."""
+    key = owner or ''
+    updated = CatalogVersion.query.filter_by(owner=key).update(
+        {CatalogVersion.version: CatalogVersion.version + 1}, synchronize_session=False)
+    if not updated:
+        db_session.add(CatalogVersion(key, 1))
+        db_session.flush()
+    return _get_catalog_version(owner)
+
 def get_user_bots(username):
     bots = []
     bot_name_prefix = get_bot_name(username, '')
-    bot_status_by_name = _get_bot_statuses(bot_name_prefix)
-    for bot_name, bot_status in bot_status_by_name.items():
-        zuliprc = _read_bot_zuliprc(bot_name)
+    bots_query = Bot.query.filter(
+        or_(Bot.owner == username,
+            and_(Bot.owner.is_(None), Bot.name.startswith(bot_name_prefix, autoescape=True))),
+        Bot.status != 'deleted')
+    other_prefixes = _get_longer_bot_name_prefixes(username)
+    for bot in bots_query.order_by(Bot.name):
+        if bot.owner is None and any(bot.name.startswith(prefix) for prefix in other_prefixes):
+            continue
         bot_info = dict(
-            name=bot_name[len(bot_name_prefix):], # remove 'username-' prefix
-            status=bot_status,
-            email=zuliprc['email'],
-            site=zuliprc['site'],
+            name=bot.name[len(bot_name_prefix):], # remove 'username-' prefix
+            status=bot.status,
+            email=bot.email,
+            site=bot.site,
         )
         bots.append(bot_info)
     return bots
 
+def _get_longer_bot_name_prefixes(username):
+    # Unowned bots named 'john-doe-bot' could belong to both 'john' and
+    # 'john-doe', so they are only listed for the longest such user.
+    bot_name_prefix = get_bot_name(username, '')
+    usernames = set(normalize_username(username) for username, in
+                    db_session.query(User.username).filter(User.username.isnot(None)))
+    return [get_bot_name(other, '') for other in usernames
+            if len(other) > len(username) and get_bot_name(other, '').startswith(bot_name_prefix)]
+
+def _is_running(bot_name):
+    bot = Bot.query.filter_by(name=bot_name).first()
+    return bot is not None and bot.status == 'running'
+
+def _is_deleted(bot_name):
+    bot = Bot.query.filter_by(name=bot_name).first()
+    return bot is not None and bot.status == 'deleted'
+
+def _update_bot_record(bot_name, owner=None, **fields):
+    # Only requests of the bot's owner pass an owner, which claims bots
+    # that were catalogued without one. Bots without a record are left to
+    # sync_bot_catalog.
+    try:
+        bot = Bot.query.filter_by(name=bot_name).first()
+        if bot is None:
+            if owner is None:
+                return
+            bot = Bot(bot_name, owner)
+            db_session.add(bot)
+        elif owner is not None and owner != bot.owner:
+            # The bot leaves the list of its previous owner.
+            bump_catalog_version(bot.owner)
+            bot.owner = owner
+        for field, value in fields.items():
+            setattr(bot, field, value)
+        bot.version = bump_catalog_version(bot.owner)
+        db_session.commit()
+    except SQLAlchemyError:
+        db_session.rollback()
+        raise
+
 def _read_bot_zuliprc(bot_name):
     bot_root = get_bot_root(bot_name)
     config = get_config(bot_root)
     zuliprc_file = os.path.join(bot_root, config['zuliprc'])
     return read_config_item(zuliprc_file, 'api')
 
+def get_running_bot_containers():
+    bot_containers = dict()
+    bot_image_name_prefix = get_bot_image_name('')
+    containers = get_docker_client().containers.list()
+    for container in containers:
+        for tag in container.image.tags:
+            if tag.startswith(bot_image_name_prefix):
+                bot_image_name = tag[:tag.find(':')] if ':' in tag else tag
+                bot_containers[extract_bot_name_from_image(bot_image_name)] = container
+                break
+    return bot_containers
+
 def _get_bot_statuses(bot_name_prefix):
     bot_status_by_name = dict()
     bot_image_name_prefix = get_bot_image_name(bot_name_prefix)
-    containers = docker_client.containers.list(all=True)
+    containers = get_docker_client().containers.list(all=True)
     for container in containers:
         for tag in container.image.tags:
             if tag.startswith(bot_image_name_prefix):
@@ -265,8 +497,82 @@ def _get_bot_statuses(bot_name_prefix):
                 bot_name = extract_bot_name_from_image(bot_image_name)
                 bot_status = container.status
                 if bot_name in bot_status_by_name:
-                    if bot_status > bot_status_by_name[bot_name]:
+                    priority = CONTAINER_STATUS_PRIORITY.get(bot_status, CONTAINER_STATUS_LOW_PRIORITY)
+                    if priority > CONTAINER_STATUS_PRIORITY.get(bot_status_by_name[bot_name],
+                                                                CONTAINER_STATUS_LOW_PRIORITY):
                         bot_status_by_name[bot_name] = bot_status
                 else:
                     bot_status_by_name[bot_name] = bot_status
-    return bot_status_by_name
\ No newline at end of file
+    return bot_status_by_name
+
+def _get_bot_image_names(bot_name_prefix):
+    bot_names = set()
+    bot_image_name_prefix = get_bot_image_name(bot_name_prefix)
+    for image in get_docker_client().images.list():
+        for tag in image.tags:
+            if tag.startswith(bot_image_name_prefix):
+                bot_names.add(extract_bot_name_from_image(tag[:tag.find(':')]))
+    return bot_names
+
+def sync_bot_catalog():
+    """Add the bots deployed before the catalog existed to it, without
+    an owner, and correct the status of the catalogued bots that were
+    running."""
+    bot_statuses = _get_bot_statuses('')
+    running_bot_containers = get_running_bot_containers()
+    catalogued = set(name for name, in db_session.query(Bot.name))
+    bot_names = (set(bot_statuses) | _get_bot_image_names('')) - catalogued
+    for bot_name in sorted(bot_names):
+        container = running_bot_containers.get(bot_name)
+        fields = dict(status='built')
+        if container is not None:
+            fields = dict(status='running', container_id=container.id)
+        elif bot_name in bot_statuses:
+            fields = dict(status='exited')
+        try:
+            zuliprc = _read_bot_zuliprc(bot_name)
+            fields.update(email=zuliprc['email'], site=zuliprc['site'])
+        except (OSError, TypeError, KeyError, configparser.Error):
+            # The bot's files may be gone; its containers still count.
+            pass
+        _add_bot_record(bot_name, **fields)
+    sync_bot_statuses(running_bot_containers)
+
+def _add_bot_record(bot_name, **fields):
+    try:
+        bot = Bot(bot_name)
+        for field, value in fields.items():
+            setattr(bot, field, value)
+        bot.version = bump_catalog_version(None)
+        db_session.add(bot)
+        db_session.commit()
+    except SQLAlchemyError:
+        db_session.rollback()
+        raise
+
+def sync_bot_statuses(running_bot_containers):
+    """Mark the bots whose container stopped by itself, e.g. because the
+    bot crashed, as exited. Takes the running containers by bot name."""
+    running_container_ids = set(container.id for container in running_bot_containers.values())
+    bot_names = [bot.name for bot in Bot.query.filter_by(status='running')
+                 if bot.container_id not in running_container_ids]
+    for bot_name in bot_names:
+        _refresh_bot_status(bot_name)
+
+@locked('refresh')
+def _refresh_bot_status(bot_name):
+    # The bot may have been started since its containers were listed.
+    bot = Bot.query.filter_by(name=bot_name).first()
+    if bot is None or bot.status != 'running':
+        return
+    try:
+        status = get_docker_client().containers.get(bot.container_id).status if bot.container_id else None
+    except NotFound:
+        status = None
+    if status != 'running':
+        _update_bot_record(bot_name, status='exited')
+
+if __name__ == '__main__':
+    # Run once when upgrading, before the API serves the bot catalog.
+    init_db()
+    sync_bot_catalog()
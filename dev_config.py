@@ -2,9 +2,65 @@ import os
 ALLOWED_EXTENSIONS = set(['.zip', '.zbot'])
 UPLOAD_FOLDER = 'bots'
 
-DATABASE_URI = 'sqlite:////tmp/github-flask.db'
+DATABASE_URI = os.environ.get('botmatrix_database_uri', 'sqlite:////tmp/github-flask.db')
 SECRET_KEY = 'development key'
 DEBUG = True
 
 GITHUB_CLIENT_ID = os.environ.get('github_client_id')
 GITHUB_CLIENT_SECRET = os.environ.get('github_client_secret')
+
+# Resource usage sampling of running bot containers
+STATS_SAMPLE_INTERVAL = 30  # seconds
+STATS_HISTORY_SIZE = 120  # samples kept per bot
+STATS_MAX_BOTS = 5000
+STATS_WORKERS = 16
+
+# Per-bot lock files shared by all API worker processes
+LOCK_FOLDER = 'locks'
+
+# Number of serialized /bots/list and /bots/logs responses cached per process
+RESPONSE_CACHE_SIZE = 1024
+
+# Per-API-key rate limiting, shared by all worker processes on the host
+RATE_LIMIT_DB = '/tmp/botmatrix-ratelimit.db'
+RATE_LIMIT_RATE = 1.0  # tokens refilled per second
+RATE_LIMIT_CAPACITY = 60
+RATE_LIMIT_DEFAULT_COST = 1
+# Cost per API endpoint
+RATE_LIMIT_COSTS = {
+    'do_process_bot': 30,
+    'upload_file': 10,
+    'do_get_log': 5,
+    'do_start_bot': 5,
+    'do_stop_bot': 5,
+    'do_delete_bot': 5,
+}
+# Endpoints that count towards the per-user concurrent operations cap
+CONCURRENCY_LIMITED_ENDPOINTS = set(['do_process_bot', 'upload_file', 'do_get_log',
+                                     'do_start_bot', 'do_stop_bot', 'do_delete_bot'])
+MAX_CONCURRENT_OPERATIONS = 2
+# Operations older than this are assumed to belong to a dead worker
+OPERATION_TIMEOUT = 15 * 60  # seconds
+
+# Background garbage collection of orphaned bot containers, images and files
+GC_INTERVAL = 10 * 60  # seconds
+GC_BATCH_SIZE = 50  # bots
+GC_WORKERS = 4
+GC_MAX_REMOVALS_PER_SECOND = 5
+
+# Number of builds per bot kept for the build time report
+BUILD_HISTORY_SIZE = 10
+
+# Deploying bots from archives uploaded to Zulip messages
+INGEST_ZULIPRC = os.environ.get('botmatrix_zuliprc', 'ingest.zuliprc')
+INGEST_WORKERS = 4
+INGEST_TIMEOUT = 30  # seconds
+# Zulip answers long polls with a heartbeat at least once a minute.
+INGEST_POLL_TIMEOUT = 90  # seconds
+INGEST_MAX_RETRY_DELAY = 60  # seconds
+MAX_BOT_ARCHIVE_SIZE = 16 * 1024 * 1024
+
+# Connections to the Docker daemon and the database are created on first use
+DOCKER_POOL_SIZE = 32  # at least STATS_WORKERS plus request threads
+DOCKER_HEALTH_CHECK_INTERVAL = 30  # seconds between pings of a pooled client
+DATABASE_POOL_RECYCLE = 30 * 60  # seconds
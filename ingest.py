@@ -0,0 +1,281 @@
+# Deploys bots from archives uploaded to Zulip messages.
+#
+# Messages are consumed in batches from a Zulip event queue. Every link to
+# an uploaded bot archive, e.g. `[mybot.zip](/user_uploads/1/ab/mybot.zip)`,
+# in a message from a user who linked their Zulip email is downloaded concurrently over one pooled HTTP session, streamed to the
+# bots directory and then extracted and built like a bot uploaded through
+# the API, within the same rate limits.
+#
+# Users link their Zulip email by sending `link <token>`, with the token
+# from `/user/zulip`, to the ingest bot in a private message; Zulip
+# authenticates the sender's email.
+
+import configparser
+import os
+import re
+import tempfile
+import time
+import zipfile
+from urllib.parse import unquote
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from docker.errors import DockerException
+from requests.adapters import HTTPAdapter
+
+import deployer
+import dev_config as config
+import ratelimit
+from models import db_session, User
+from naming import get_bot_name, normalize_username
+
+UPLOAD_LINK_PATTERN = re.compile(r'\[([^\]]+)\]\((/user_uploads/[^)\s]+)\)')
+# Only paths of uploaded files; anything else would make the ingest bot
+# fetch other API endpoints with its credentials.
+UPLOAD_PATH_PATTERN = re.compile(r'^/user_uploads/\d+/[\w-]+/[^/?#]+$')
+LINK_PATTERN = re.compile(r'^\s*link\s+([0-9a-f]+)\s*$')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Deploying an upload takes both an upload and a process request.
+UPLOAD_ENDPOINTS = ['upload_file', 'do_process_bot']
+
+class DownloadError(Exception):
+    def __init__(self, msg):
+        super(DownloadError, self).__init__(msg)
+
+def is_upload_path(path: str) -> bool:
+    return UPLOAD_PATH_PATTERN.match(path) is not None and '..' not in unquote(path)
+
+def find_sender(message: Dict[str, Any]) -> Optional[User]:
+    user = User.query.filter_by(zulip_email=message['sender_email']).first()
+    if user is None or not user.username:
+        return None
+    return user
+
+def link_sender(message: Dict[str, Any], token: str) -> Optional[User]:
+    """Link the sender's Zulip email to the user `token` was issued to."""
+    # Tokens posted to streams are visible to others.
+    if message['type'] != 'private':
+        return None
+    user = User.query.filter_by(zulip_link_token=token).first()
+    if user is None:
+        return None
+    email = message['sender_email']
+    for other_user in User.query.filter_by(zulip_email=email):
+        other_user.zulip_email = None
+    user.zulip_email = email
+    user.zulip_link_token = None
+    db_session.commit()
+    return user
+
+def parse_bot_uploads(message: Dict[str, Any], user: User) -> List[Dict[str, Any]]:
+    uploads = []
+    for file_name, path in UPLOAD_LINK_PATTERN.findall(message['content']):
+        name, ext = os.path.splitext(file_name)
+        if ext not in config.ALLOWED_EXTENSIONS or not is_upload_path(path):
+            continue
+        uploads.append(dict(
+            bot_name=get_bot_name(user.username, name),
+            owner=normalize_username(user.username),
+            user_id=user.id,
+            ext=ext,
+            path=path,
+        ))
+    return uploads
+
+def print_result(future: Future) -> None:
+    if future.exception() is not None:
+        print("Deploying upload failed: " + str(future.exception()))
+        return
+    result = future.result()
+    print(result['name'] + ": " + result.get('message', result['status']))
+
+class BotIngestor:
+    def __init__(self,
+                 site: str,
+                 email: str,
+                 api_key: str,
+                 workers: int = config.INGEST_WORKERS,
+                 timeout: float = config.INGEST_TIMEOUT,
+                 max_size: int = config.MAX_BOT_ARCHIVE_SIZE,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.site = site.rstrip('/')
+        self.timeout = timeout
+        self.max_size = max_size
+        self.sleep = sleep
+        # One session shared by all workers, with a connection for each.
+        self.session = requests.Session()
+        self.session.auth = (email, api_key)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
+
+    def submit_messages(self, messages: List[Dict[str, Any]]) -> List[Future]:
+        """Start deploying the uploads in `messages` without waiting for them."""
+        futures = []
+        try:
+            for message in messages:
+                match = LINK_PATTERN.match(message['content'])
+                if match is not None:
+                    user = link_sender(message, match.group(1))
+                    if user is None:
+                        print("Ignoring invalid link request from " + message['sender_email'])
+                    else:
+                        print("Linked {} to {}".format(message['sender_email'], user.username))
+                    continue
+                user = find_sender(message)
+                if user is None:
+                    if UPLOAD_LINK_PATTERN.search(message['content']):
+                        print("Ignoring uploads from unknown sender " + message['sender_email'])
+                    continue
+                for upload in parse_bot_uploads(message, user):
+                    futures.append(self.executor.submit(self.deploy_upload, upload))
+        finally:
+            db_session.remove()
+        return futures
+
+    def handle_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        return [future.result() for future in self.submit_messages(messages)]
+
+    def deploy_upload(self, upload: Dict[str, Any]) -> Dict[str, str]:
+        bot_name = upload['bot_name']
+        result = dict(name=bot_name, status='error')
+        key = ratelimit.get_user_key(upload['user_id'])
+        operation_id = ratelimit.limiter.acquire(key)
+        if operation_id is None:
+            result['message'] = "Failure. Too many operations in progress."
+            return result
+        try:
+            cost = sum(ratelimit.get_cost(endpoint) for endpoint in UPLOAD_ENDPOINTS)
+            if ratelimit.limiter.consume(key, cost) > 0:
+                result['message'] = "Failure. Rate limit exceeded."
+                return result
+            return self._deploy_upload(upload, result)
+        finally:
+            ratelimit.limiter.release(operation_id)
+
+    def _deploy_upload(self, upload: Dict[str, Any], result: Dict[str, str]) -> Dict[str, str]:
+        bot_name = upload['bot_name']
+        try:
+            self.download(upload['path'], bot_name + upload['ext'])
+        except (DownloadError, requests.RequestException, OSError) as e:
+            result['message'] = "Failure. Could not download bot: " + str(e)
+            return result
+        try:
+            with deployer.bot_lock(bot_name, 'process'):
+                if not deployer.extract_file(bot_name, upload['owner']):
+                    result['message'] = "Failure. Bot zip file not found."
+                elif not deployer.check_and_load_structure(bot_name):
+                    result['message'] = "Failure. Something's wrong with your zip file."
+                else:
+                    deployer.create_docker_image(bot_name)
+                    result['status'] = 'success'
+        except deployer.BuildError as e:
+            result['message'] = "Failure. Build failed: " + str(e)
+        except (zipfile.BadZipFile, configparser.Error, KeyError, TypeError, OSError) as e:
+            # A broken archive only fails its own upload.
+            result['message'] = "Failure. Something's wrong with your zip file: " + str(e)
+        except DockerException as e:
+            result['message'] = "Failure. Could not build bot: " + str(e)
+        finally:
+            db_session.remove()
+        return result
+
+    def download(self, path: str, file_name: str) -> str:
+        """Stream the upload at `path` into the bots directory, without
+        ever holding the whole file in memory."""
+        if not is_upload_path(path):
+            raise DownloadError("Not a link to an uploaded file: " + path)
+        bots_dir = deployer.get_bots_dir()
+        with self.session.get(self.site + path, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            content_length = response.headers.get('Content-Length')
+            if content_length is not None and int(content_length) > self.max_size:
+                raise DownloadError("File is larger than {} bytes.".format(self.max_size))
+            # Write to a temporary file first so that a partial download
+            # never replaces an existing archive.
+            fd, temp_path = tempfile.mkstemp(dir=bots_dir, prefix='.download-')
+            try:
+                size = 0
+                with os.fdopen(fd, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_size:
+                            raise DownloadError("File is larger than {} bytes.".format(self.max_size))
+                        file.write(chunk)
+                file_path = os.path.join(bots_dir, file_name)
+                with deployer.bot_lock(os.path.splitext(file_name)[0], 'upload'):
+                    os.replace(temp_path, file_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        return file_path
+
+    def register_queue(self) -> Dict[str, Any]:
+        response = self.session.post(self.site + '/api/v1/register',
+                                     # Message contents as written, not rendered to HTML
+                                     data=dict(event_types='["message"]', apply_markdown='false'),
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_messages(self, queue: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # Long polls until the server has new events.
+        response = self.session.get(self.site + '/api/v1/events',
+                                    params=dict(queue_id=queue['queue_id'],
+                                                last_event_id=queue['last_event_id']),
+                                    timeout=(self.timeout, config.INGEST_POLL_TIMEOUT))
+        response.raise_for_status()
+        events = response.json()['events']
+        if events:
+            queue['last_event_id'] = max(event['id'] for event in events)
+        return [event['message'] for event in events if event['type'] == 'message']
+
+    def run(self, batches: Optional[int] = None) -> None:
+        queue = None  # type: Optional[Dict[str, Any]]
+        failures = 0
+        while batches is None or batches > 0:
+            try:
+                if queue is None:
+                    queue = self.register_queue()
+                messages = self.get_messages(queue)
+            except requests.HTTPError as e:
+                status_code = e.response.status_code if e.response is not None else None
+                if status_code == 400 and queue is not None:
+                    # The server expires event queues that were idle for
+                    # too long, or lost them when it restarted.
+                    queue = None
+                    continue
+                if status_code is not None and status_code < 500 and status_code != 429:
+                    raise
+                failures += 1
+                self.wait_to_retry(failures, e)
+                continue
+            except (requests.ConnectionError, requests.Timeout) as e:
+                failures += 1
+                self.wait_to_retry(failures, e)
+                continue
+            failures = 0
+            # Keep polling while the uploads are deployed.
+            for future in self.submit_messages(messages):
+                future.add_done_callback(print_result)
+            if batches is not None:
+                batches -= 1
+
+    def wait_to_retry(self, failures: int, error: Exception) -> None:
+        # Back off exponentially while the server is unreachable.
+        delay = min(2 ** (failures - 1), config.INGEST_MAX_RETRY_DELAY)
+        print("Polling Zulip failed, retrying in {} seconds: {}".format(delay, error))
+        self.sleep(delay)
+
+def create_ingestor(zuliprc_file: str = config.INGEST_ZULIPRC) -> BotIngestor:
+    zuliprc = deployer.read_config_item(zuliprc_file, 'api')
+    return BotIngestor(zuliprc['site'], zuliprc['email'], zuliprc['key'])
+
+if __name__ == '__main__':
+    create_ingestor().run()
@@ -0,0 +1,88 @@
+# Per-bot locks for the deployer's mutating operations.
+#
+# Locks are `flock`s on one file per bot, so they serialize operations on
+# the same bot across threads and across API worker processes, while
+# operations on different bots run in parallel. Reads don't take locks.
+
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict
+
+import dev_config as config
+
+LOCKS_DIR = config.LOCK_FOLDER
+
+class LockMetrics:
+    """Wait and hold times of the locks taken by this process, per operation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()  # type: Dict[str, Dict[str, float]]
+
+    def record(self, operation: str, wait_time: float, hold_time: float) -> None:
+        with self._lock:
+            metrics = self._metrics.setdefault(operation, dict(
+                count=0, wait_total=0.0, wait_max=0.0, hold_total=0.0, hold_max=0.0))
+            metrics['count'] += 1
+            metrics['wait_total'] += wait_time
+            metrics['wait_max'] = max(metrics['wait_max'], wait_time)
+            metrics['hold_total'] += hold_time
+            metrics['hold_max'] = max(metrics['hold_max'], hold_time)
+
+    def get(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {operation: dict(metrics) for operation, metrics in self._metrics.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._metrics.clear()
+
+metrics = LockMetrics()
+
+_held = threading.local()
+
+def _held_locks():
+    if not hasattr(_held, 'bot_names'):
+        _held.bot_names = set()
+    return _held.bot_names
+
+def get_lock_path(bot_name: str) -> str:
+    return os.path.join(LOCKS_DIR, bot_name + '.lock')
+
+@contextmanager
+def bot_lock(bot_name: str, operation: str = 'default'):
+    held = _held_locks()
+    if bot_name in held:
+        # Already held by this thread, e.g. extract_file within a process.
+        yield
+        return
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    requested = time.monotonic()
+    lock_fd = os.open(get_lock_path(bot_name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        acquired = time.monotonic()
+        held.add(bot_name)
+        try:
+            yield
+        finally:
+            held.discard(bot_name)
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            metrics.record(operation, acquired - requested, time.monotonic() - acquired)
+    finally:
+        os.close(lock_fd)
+
+def locked(operation: str):
+    """Run the decorated function, whose first argument is a bot name,
+    while holding that bot's lock."""
+    def decorator(function):
+        @wraps(function)
+        def decorated_function(bot_name, *args, **kwargs):
+            with bot_lock(bot_name, operation):
+                return function(bot_name, *args, **kwargs)
+        return decorated_function
+    return decorator
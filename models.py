@@ -0,0 +1,142 @@
+import threading
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, DateTime, Float, Boolean, Text
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
+from sqlalchemy.ext.declarative import declarative_base
+
+import dev_config as config
+
+# The engine is created on first use, so that importing the models is
+# cheap and doesn't need the database.
+engine = None
+engine_lock = threading.Lock()
+
+def get_engine():
+	global engine
+	if engine is None:
+		with engine_lock:
+			if engine is None:
+				# pool_pre_ping replaces connections that went stale while
+				# they sat in the pool.
+				engine = create_engine(config.DATABASE_URI,
+									   pool_pre_ping=True,
+									   pool_recycle=config.DATABASE_POOL_RECYCLE)
+	return engine
+
+class LazySession(Session):
+	def get_bind(self, *args, **kwargs):
+		if self.bind is None:
+			self.bind = get_engine()
+		return super(LazySession, self).get_bind(*args, **kwargs)
+
+db_session = scoped_session(sessionmaker(class_=LazySession,
+										 autocommit=False,
+										 autoflush=False))
+Base = declarative_base()
+Base.query = db_session.query_property()
+
+
+def init_db():
+	Base.metadata.create_all(bind=get_engine())
+	add_missing_columns(get_engine())
+
+def add_missing_columns(engine):
+	# create_all only creates missing tables, so add the columns that were
+	# added to existing tables since. New columns must be nullable or have
+	# a server default.
+	inspector = inspect(engine)
+	with engine.begin() as connection:
+		for table in Base.metadata.sorted_tables:
+			existing = set(column['name'] for column in inspector.get_columns(table.name))
+			for column in table.columns:
+				if column.name in existing:
+					continue
+				ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+					table.name, column.name, column.type.compile(dialect=engine.dialect))
+				if column.server_default is not None:
+					ddl += ' NOT NULL DEFAULT {}'.format(column.server_default.arg)
+				connection.execute(text(ddl))
+
+class User(Base):
+	__tablename__ = 'users'
+
+	id = Column(Integer, primary_key=True)
+	username = Column(String(200))
+	github_access_token = Column(String(200))
+	api_key = Column(String(200))
+	# Bots uploaded to Zulip messages from this address are deployed for the user
+	zulip_email = Column(String(200), index=True)
+	# One-time token the user sends to the ingest bot to link zulip_email
+	zulip_link_token = Column(String(64), index=True)
+
+	def __init__(self, github_access_token):
+		self.github_access_token = github_access_token
+
+class Bot(Base):
+	__tablename__ = 'bots'
+
+	id = Column(Integer, primary_key=True)
+	# Full bot name, i.e. '<owner>-<name>'
+	name = Column(String(200), unique=True, nullable=False)
+	# None for bots deployed before the catalog existed, until their
+	# owner processes or deletes them
+	owner = Column(String(200), index=True)
+	image_id = Column(String(100))
+	container_id = Column(String(100))
+	archive_hash = Column(String(64))
+	email = Column(String(200))
+	site = Column(String(200))
+	status = Column(String(20))
+	# The owner's catalog version as of the latest change to the bot
+	version = Column(Integer, default=0, server_default='0', nullable=False)
+	created_at = Column(DateTime, default=datetime.utcnow)
+	updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+	def __init__(self, name, owner=None):
+		self.name = name
+		self.owner = owner
+
+class CatalogVersion(Base):
+	__tablename__ = 'catalog_versions'
+
+	# '' for the bots without an owner
+	owner = Column(String(200), primary_key=True)
+	# Incremented on every change to the owner's bots and never reset,
+	# unlike counts or ids of bots, which deleting bots can repeat
+	version = Column(Integer, nullable=False)
+
+	def __init__(self, owner, version):
+		self.owner = owner
+		self.version = version
+
+class Build(Base):
+	__tablename__ = 'builds'
+
+	id = Column(Integer, primary_key=True)
+	bot_name = Column(String(200), index=True, nullable=False)
+	started_at = Column(DateTime, default=datetime.utcnow)
+	duration = Column(Float)
+	success = Column(Boolean)
+	# JSON object with the seconds spent in each build stage
+	stages = Column(Text)
+
+	def __init__(self, bot_name):
+		self.bot_name = bot_name
+
+class BotUsage(Base):
+	__tablename__ = 'bot_usage'
+
+	id = Column(Integer, primary_key=True)
+	bot_name = Column(String(200), unique=True, nullable=False)
+	# Unix time of the latest sample
+	updated = Column(Float)
+	samples = Column(Integer)
+	cpu_last = Column(Float)
+	cpu_avg = Column(Float)
+	cpu_max = Column(Float)
+	memory_last = Column(Float)
+	memory_avg = Column(Float)
+	memory_max = Column(Float)
+
+	def __init__(self, bot_name):
+		self.bot_name = bot_name
@@ -0,0 +1,254 @@
+# Sampling of the CPU and memory used by running bot containers.
+#
+# A single sampler process (`python monitor.py`) periodically reads one-shot
+# `container.stats()` for every running bot concurrently and appends the
+# results to fixed-size ring buffers. After every sweep it writes a summary
+# of each bot's history to the database, and marks the catalogued bots
+# that are no longer running as exited. API handlers only ever read those
+# summaries, so they never wait on the Docker daemon.
+
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from docker.errors import DockerException
+from sqlalchemy.exc import SQLAlchemyError
+
+import deployer
+import dev_config as config
+from models import db_session, init_db, Bot, BotUsage
+
+class UsageHistory:
+    """Ring buffer of (timestamp, cpu percent, memory bytes) samples."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.timestamps = array('d', [0.0]) * size
+        self.cpu = array('f', [0.0]) * size
+        self.memory = array('d', [0.0]) * size
+        self.count = 0
+        self.next = 0
+        # Raw (container CPU time, system CPU time) of the latest stats, to
+        # compute the CPU usage of the next sample against.
+        self.cpu_usage = None  # type: Optional[Tuple[float, float]]
+
+    def add(self, timestamp: float, cpu: float, memory: float) -> None:
+        self.timestamps[self.next] = timestamp
+        self.cpu[self.next] = cpu
+        self.memory[self.next] = memory
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self) -> List[Tuple[float, float, float]]:
+        start = (self.next - self.count) % self.size
+        indexes = [(start + i) % self.size for i in range(self.count)]
+        return [(self.timestamps[i], self.cpu[i], self.memory[i]) for i in indexes]
+
+    def last(self) -> Optional[Tuple[float, float, float]]:
+        if self.count == 0:
+            return None
+        i = (self.next - 1) % self.size
+        return (self.timestamps[i], self.cpu[i], self.memory[i])
+
+    def summary(self) -> Dict[str, Any]:
+        if self.count == 0:
+            return dict(samples=0)
+        cpu = self.cpu[:self.count] if self.count < self.size else self.cpu
+        memory = self.memory[:self.count] if self.count < self.size else self.memory
+        timestamp, last_cpu, last_memory = self.last()
+        return dict(
+            samples=self.count,
+            updated=timestamp,
+            cpu=dict(last=last_cpu, avg=sum(cpu) / self.count, max=max(cpu)),
+            memory=dict(last=last_memory, avg=sum(memory) / self.count, max=max(memory)),
+        )
+
+def cpu_usage(stats: Dict[str, Any]) -> Tuple[float, float]:
+    cpu_stats = stats.get('cpu_stats', {})
+    return (cpu_stats.get('cpu_usage', {}).get('total_usage', 0),
+            cpu_stats.get('system_cpu_usage', 0))
+
+def cpu_percent(stats: Dict[str, Any], previous_usage: Tuple[float, float]) -> float:
+    # One-shot stats don't carry a previous reading, so the CPU time used
+    # is measured against the previous sample of the same bot.
+    cpu_stats = stats.get('cpu_stats', {})
+    total_usage, system_usage = cpu_usage(stats)
+    cpu_delta = total_usage - previous_usage[0]
+    system_delta = system_usage - previous_usage[1]
+    if cpu_delta <= 0 or system_delta <= 0:
+        # Also the case when the container was restarted in between.
+        return 0.0
+    online_cpus = (cpu_stats.get('online_cpus') or
+                   len(cpu_stats.get('cpu_usage', {}).get('percpu_usage') or []) or 1)
+    return cpu_delta / system_delta * online_cpus * 100.0
+
+def memory_usage(stats: Dict[str, Any]) -> float:
+    memory_stats = stats.get('memory_stats', {})
+    usage = memory_stats.get('usage', 0)
+    # Page cache is reclaimable, so don't charge it to the bot.
+    details = memory_stats.get('stats', {})
+    cache = details.get('inactive_file', details.get('cache', 0))
+    return float(max(0, usage - cache))
+
+class ResourceSampler:
+    def __init__(self,
+                 interval: float = config.STATS_SAMPLE_INTERVAL,
+                 history_size: int = config.STATS_HISTORY_SIZE,
+                 max_bots: int = config.STATS_MAX_BOTS,
+                 workers: int = config.STATS_WORKERS):
+        self.interval = interval
+        self.history_size = history_size
+        self.max_bots = max_bots
+        self.workers = workers
+        self._histories = OrderedDict()  # type: Dict[str, UsageHistory]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_once()
+            except Exception as e:
+                print("Resource sampling failed: " + str(e))
+            self._stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def sample_once(self) -> None:
+        bot_containers = deployer.get_running_bot_containers()
+        if bot_containers:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            futures = {self._executor.submit(_read_stats, container): bot_name
+                       for bot_name, container in bot_containers.items()}
+            for future in as_completed(futures):
+                result = future.result()
+                if result is not None:
+                    timestamp, stats = result
+                    self.record_stats(futures[future], timestamp, stats)
+        try:
+            deployer.sync_bot_statuses(bot_containers)
+        except Exception as e:
+            print("Could not refresh bot statuses: " + str(e))
+        self.store_usage()
+
+    def record_stats(self, bot_name: str, timestamp: float, stats: Dict[str, Any]) -> None:
+        with self._lock:
+            history = self._get_history(bot_name)
+            previous_usage = history.cpu_usage
+            history.cpu_usage = cpu_usage(stats)
+            # The first stats of a bot are only a baseline for the next ones.
+            if previous_usage is not None:
+                history.add(timestamp, cpu_percent(stats, previous_usage), memory_usage(stats))
+
+    def record(self, bot_name: str, timestamp: float, cpu: float, memory: float) -> None:
+        with self._lock:
+            self._get_history(bot_name).add(timestamp, cpu, memory)
+
+    def _get_history(self, bot_name: str) -> UsageHistory:
+        history = self._histories.get(bot_name)
+        if history is None:
+            history = UsageHistory(self.history_size)
+            self._histories[bot_name] = history
+        else:
+            self._histories.move_to_end(bot_name)
+        # Forget the bots that were updated least recently.
+        while len(self._histories) > self.max_bots:
+            self._histories.popitem(last=False)
+        return history
+
+    def store_usage(self) -> None:
+        """Replace the usage summaries in the database with the current ones."""
+        bot_usage = {bot_name: usage for bot_name, usage in self.get_bot_usage().items()
+                     if usage['samples']}
+        try:
+            for row in BotUsage.query:
+                usage = bot_usage.pop(row.bot_name, None)
+                if usage is None:
+                    db_session.delete(row)
+                else:
+                    _set_usage(row, usage)
+            for bot_name, usage in bot_usage.items():
+                row = BotUsage(bot_name)
+                _set_usage(row, usage)
+                db_session.add(row)
+            db_session.commit()
+        except SQLAlchemyError:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.remove()
+
+    def get_bot_usage(self, bot_name_prefix: str = '') -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {bot_name: history.summary()
+                    for bot_name, history in self._histories.items()
+                    if bot_name.startswith(bot_name_prefix)}
+
+    def get_bot_history(self, bot_name: str) -> List[Tuple[float, float, float]]:
+        with self._lock:
+            history = self._histories.get(bot_name)
+            return history.samples() if history is not None else []
+
+def _read_stats(container) -> Optional[Tuple[float, Dict[str, Any]]]:
+    try:
+        stats = container.stats(stream=False, one_shot=True)
+        return time.time(), stats
+    except DockerException as e:
+        # The container most likely stopped between listing and sampling.
+        print("Could not read stats of container " + container.short_id + ": " + str(e))
+        return None
+
+def _set_usage(row: BotUsage, usage: Dict[str, Any]) -> None:
+    row.updated = usage['updated']
+    row.samples = usage['samples']
+    row.cpu_last = usage['cpu']['last']
+    row.cpu_avg = usage['cpu']['avg']
+    row.cpu_max = usage['cpu']['max']
+    row.memory_last = usage['memory']['last']
+    row.memory_avg = usage['memory']['avg']
+    row.memory_max = usage['memory']['max']
+
+def get_bot_usage(owner: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """Read the usage summaries that the sampler process stored, of all
+    bots or only of the bots of `owner`."""
+    bot_usage = dict()
+    rows = BotUsage.query
+    if owner is not None:
+        # Bot names alone can't tell apart the bots of 'john' and 'john-doe'.
+        rows = rows.join(Bot, Bot.name == BotUsage.bot_name).filter(Bot.owner == owner)
+    for row in rows:
+        bot_usage[row.bot_name] = dict(
+            samples=row.samples,
+            updated=row.updated,
+            cpu=dict(last=row.cpu_last, avg=row.cpu_avg, max=row.cpu_max),
+            memory=dict(last=row.memory_last, avg=row.memory_avg, max=row.memory_max),
+        )
+    return bot_usage
+
+def summarize_usage(bot_usage: Dict[str, Dict[str, Any]], active_since: float) -> Dict[str, Any]:
+    # Bots without a recent sample are no longer running and use nothing.
+    active = [usage for usage in bot_usage.values()
+              if usage['samples'] and usage['updated'] >= active_since]
+    return dict(
+        bots=len(bot_usage),
+        active=len(active),
+        cpu=sum(usage['cpu']['last'] for usage in active),
+        memory=sum(usage['memory']['last'] for usage in active),
+    )
+
+sampler = ResourceSampler()
+
+if __name__ == '__main__':
+    # Run exactly one sampler; any number of API processes read its results.
+    init_db()
+    sampler.run()
@@ -1,6 +1,8 @@
 from werkzeug.utils import secure_filename
 
 BOT_IMAGE_PREFIX = 'zulip-'
+# Label on bot images and containers whose value is the bot name
+BOT_LABEL = 'botmatrix.bot'
 
 def normalize_username(username: str) -> str:
     return secure_filename(username)
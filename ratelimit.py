@@ -0,0 +1,122 @@
+# Per-user token bucket rate limiting and concurrent operation caps.
+#
+# State lives in a local SQLite database so that every worker process on
+# the host enforces the same limits. Users are only known to it by id.
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+import dev_config as config
+
+class RateLimiter:
+    def __init__(self,
+                 path: str = config.RATE_LIMIT_DB,
+                 rate: float = config.RATE_LIMIT_RATE,
+                 capacity: float = config.RATE_LIMIT_CAPACITY,
+                 max_concurrent: int = config.MAX_CONCURRENT_OPERATIONS,
+                 operation_timeout: float = config.OPERATION_TIMEOUT,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+        self.max_concurrent = max_concurrent
+        self.operation_timeout = operation_timeout
+        self.clock = clock
+        self._local = threading.local()
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if not self._initialized:
+                self._create_db_file()
+            # Autocommit mode; transactions are started explicitly with
+            # BEGIN IMMEDIATE so that read-modify-write is atomic.
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.connection = connection
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                                       '(key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+                    connection.execute('CREATE TABLE IF NOT EXISTS operations '
+                                       '(id INTEGER PRIMARY KEY, key TEXT, started REAL)')
+                    connection.execute('CREATE INDEX IF NOT EXISTS operations_key ON operations (key)')
+                    self._initialized = True
+        return connection
+
+    def _create_db_file(self) -> None:
+        # Only the user running the app may read or change the limits;
+        # SQLite gives its journal files the same permissions.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+    def consume(self, key: str, cost: float) -> float:
+        """Take `cost` tokens from the bucket of `key`. Returns 0 on success,
+        otherwise the number of seconds until enough tokens are available."""
+        cost = min(cost, self.capacity)
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = self.clock()
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                tokens = self.capacity
+            else:
+                tokens = min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / self.rate
+            connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def acquire(self, key: str) -> Optional[int]:
+        """Start an operation for `key`. Returns an operation id to pass to
+        `release`, or None if `key` already runs too many operations."""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = self.clock()
+            connection.execute('DELETE FROM operations WHERE started < ?',
+                               (now - self.operation_timeout,))
+            running, = connection.execute('SELECT COUNT(*) FROM operations WHERE key = ?',
+                                          (key,)).fetchone()
+            operation_id = None
+            if running < self.max_concurrent:
+                operation_id = connection.execute('INSERT INTO operations (key, started) VALUES (?, ?)',
+                                                  (key, now)).lastrowid
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return operation_id
+
+    def release(self, operation_id: int) -> None:
+        self._connection().execute('DELETE FROM operations WHERE id = ?', (operation_id,))
+
+def get_user_key(user_id: int) -> str:
+    return 'user:{}'.format(user_id)
+
+def get_cost(endpoint: str) -> float:
+    return config.RATE_LIMIT_COSTS.get(endpoint, config.RATE_LIMIT_DEFAULT_COST)
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, int(math.ceil(seconds))))
+
+limiter = RateLimiter()
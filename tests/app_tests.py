@@ -0,0 +1,124 @@
+from unittest import TestCase
+from unittest.mock import patch
+import io
+import json
+import os
+import sqlite3
+import tempfile
+
+from tests.test_lib import setup_test_db, teardown_test_db, setup_test_locks_dir, teardown_test_locks_dir, \
+    add_bot_record
+
+from models import User, db_session
+from ratelimit import RateLimiter
+import app
+import deployer
+
+class AppTest(TestCase):
+
+    def setUp(self):
+        self.db_engine = setup_test_db()
+        self.locks_dir, self.locks_dir_patch = setup_test_locks_dir()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bots_dir = os.path.join(self.temp_dir.name, 'bots')
+        os.mkdir(self.bots_dir)
+        limiter = RateLimiter(path=os.path.join(self.temp_dir.name, 'ratelimit.db'), rate=1.0, capacity=100)
+        self.patches = [
+            patch('deployer.BOTS_DIR', new=self.bots_dir),
+            patch('ratelimit.limiter', new=limiter),
+            patch('app.github.get', return_value=dict(login='user1')),
+        ]
+        for p in self.patches:
+            p.start()
+        user = User('token')
+        user.api_key = 'key'
+        db_session.add(user)
+        db_session.commit()
+        app.response_cache.clear()
+        self.client = app.app.test_client()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.temp_dir.cleanup()
+        teardown_test_locks_dir(self.locks_dir, self.locks_dir_patch)
+        teardown_test_db(self.db_engine)
+
+    def test_upload_file(self):
+        response = self.client.post('/bots/upload', headers=dict(key='key'),
+                                    data=dict(file=(io.BytesIO(b'bot archive'), 'bot1.zip')))
+        self.assertEqual(json.loads(response.get_data(as_text=True))['status'], 'success')
+        # Nothing but the archive is left behind.
+        self.assertListEqual(os.listdir(self.bots_dir), ['user1-bot1.zip'])
+        with open(os.path.join(self.bots_dir, 'user1-bot1.zip'), 'rb') as file:
+            self.assertEqual(file.read(), b'bot archive')
+
+    def test_unknown_api_key(self):
+        self.assertEqual(self.client.get('/bots/list', headers=dict(key='other')).status_code, 401)
+
+    def test_list_bots_not_modified(self):
+        add_bot_record('user1-bot1', 'user1', status='built')
+        response = self.client.get('/bots/list', headers=dict(key='key'))
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/bots/list', headers={'key': 'key', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        # A change to the catalog changes the ETag.
+        deployer._update_bot_record('user1-bot1', status='running')
+        response = self.client.get('/bots/list', headers={'key': 'key', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_list_bots_served_from_cache(self):
+        add_bot_record('user1-bot1', 'user1', status='built')
+        response = self.client.get('/bots/list', headers=dict(key='key'))
+        with patch('deployer.get_user_bots') as get_user_bots:
+            cached_response = self.client.get('/bots/list', headers=dict(key='key'))
+        get_user_bots.assert_not_called()
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.get_data(), response.get_data())
+        self.assertEqual(cached_response.headers['ETag'], response.headers['ETag'])
+
+    def test_logs_of_stopped_bot_not_modified(self):
+        add_bot_record('user1-bot1', 'user1', status='exited', container_id='c1')
+        with patch('deployer.bot_log', return_value='some logs') as bot_log:
+            response = self.client.get('/bots/logs/bot1', headers=dict(key='key'),
+                                       data=json.dumps(dict(name='bot1')))
+            self.assertEqual(json.loads(response.get_data(as_text=True))['logs']['content'], 'some logs')
+            response = self.client.get('/bots/logs/bot1',
+                                       headers={'key': 'key', 'If-None-Match': response.headers['ETag']},
+                                       data=json.dumps(dict(name='bot1')))
+        self.assertEqual(response.status_code, 304)
+        bot_log.assert_called_once_with('user1-bot1', lines=None)
+
+    def test_rate_limit_exceeded(self):
+        limiter = RateLimiter(path=os.path.join(self.temp_dir.name, 'limited.db'), rate=0.25, capacity=2)
+        with patch('ratelimit.limiter', new=limiter):
+            responses = [self.client.get('/bots/list', headers=dict(key='key')) for i in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(json.loads(responses[2].get_data(as_text=True))['status'], 'error')
+        self.assertIn(responses[2].headers['Retry-After'], ['3', '4'])
+        # The API key itself is never stored.
+        connection = sqlite3.connect(limiter.path)
+        self.assertEqual(connection.execute('SELECT key FROM buckets').fetchall(), [('user:1',)])
+        connection.close()
+
+    def test_get_build_log(self):
+        response = self.client.get('/bots/builds/bot1/log', headers=dict(key='key'))
+        self.assertEqual(json.loads(response.get_data(as_text=True))['status'], 'error')
+        os.mkdir(os.path.join(self.bots_dir, 'user1-bot1'))
+        with open(os.path.join(self.bots_dir, 'user1-bot1', deployer.BUILD_LOG_FILE), 'w') as build_log:
+            build_log.write('Step 1/6 : FROM python:3\n')
+        response = self.client.get('/bots/builds/bot1/log', headers=dict(key='key'))
+        self.assertEqual(json.loads(response.get_data(as_text=True))['build_log']['content'],
+                         'Step 1/6 : FROM python:3\n')
+
+    def test_set_zulip_email(self):
+        response = json.loads(self.client.post('/user/zulip', headers=dict(key='key')).get_data(as_text=True))
+        self.assertEqual(response['status'], 'success')
+        self.assertIn('link ' + response['token'], response['message'])
+        # The email itself is only set once the token is sent from it.
+        user = User.query.filter_by(api_key='key').one()
+        self.assertEqual((user.zulip_email, user.zulip_link_token, user.username),
+                         (None, response['token'], 'user1'))
@@ -0,0 +1,141 @@
+from unittest import TestCase
+from unittest.mock import patch
+from datetime import datetime, timedelta
+import os
+import tempfile
+
+from tests.test_lib import test_docker_client, setup_test_db, teardown_test_db, add_bot_record, \
+    setup_test_locks_dir, teardown_test_locks_dir
+
+from collector import GarbageCollector
+from models import Bot, BotUsage, Build, db_session
+
+class GarbageCollectorTest(TestCase):
+
+    def setUp(self):
+        self.db_engine = setup_test_db()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bots_dir = os.path.join(self.temp_dir.name, 'bots')
+        os.mkdir(self.bots_dir)
+        self.bots_dir_patch = patch('deployer.BOTS_DIR', new=self.bots_dir)
+        self.bots_dir_patch.start()
+        self.locks_dir, self.locks_dir_patch = setup_test_locks_dir()
+        self.collector = GarbageCollector(interval=60, batch_size=2, workers=2,
+                                          max_removals_per_second=1000)
+
+    def tearDown(self):
+        teardown_test_locks_dir(self.locks_dir, self.locks_dir_patch)
+        self.bots_dir_patch.stop()
+        self.temp_dir.cleanup()
+        teardown_test_db(self.db_engine)
+
+    def create_bot_files(self, bot_name, archive=True):
+        os.mkdir(os.path.join(self.bots_dir, bot_name))
+        if archive:
+            open(os.path.join(self.bots_dir, bot_name + '.zip'), 'w').close()
+
+    def create_docker_client(self):
+        return test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='running'),
+                dict(id='c2', image_id='i1', status='exited'),
+                dict(id='c3', image_id='i2', status='paused'),
+                dict(id='c4', image_id='i3', status='running'),
+                dict(id='c5', image_id='i3', status='exited'),
+                dict(id='c6', image_id='i4', status='exited',
+                     labels={'botmatrix.bot': 'user1-another_bot'}),
+                dict(id='c7', image_id='i5', status='exited'),
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-user1-bot_1']),
+                dict(id='i2', tags=['zulip-user1-bot_1:latest']),
+                dict(id='i3', tags=['zulip-user1-another_bot:latest']),
+                # The previous build of another_bot
+                dict(id='i4', tags=[], labels={'botmatrix.bot': 'user1-another_bot'}),
+                # A bot that predates the catalog
+                dict(id='i5', tags=['zulip-user2-old_bot:latest']),
+            ]
+        )
+
+    def add_bots(self):
+        deleted_at = datetime.utcnow() + timedelta(seconds=1)
+        add_bot_record('user1-bot_1', 'user1', status='deleted', updated_at=deleted_at)
+        add_bot_record('user1-another_bot', 'user1', status='running', container_id='c4')
+        self.create_bot_files('user1-bot_1')
+        self.create_bot_files('user1-another_bot')
+        self.create_bot_files('user2-old_bot')
+        self.create_bot_files('user2-removed_bot', archive=False)
+
+    def test_dry_run_reports_orphans(self):
+        self.add_bots()
+        docker_client = self.create_docker_client()
+        with patch('deployer.docker_client', new=docker_client):
+            report = self.collector.collect(dry_run=True)
+
+        orphans = sorted((orphan['kind'], orphan['name'], orphan['reason']) for orphan in report['orphans'])
+        self.assertListEqual(orphans, [
+            ('container', 'c1', 'bot deleted'),
+            ('container', 'c2', 'bot deleted'),
+            ('container', 'c3', 'bot deleted'),
+            ('container', 'c5', 'stale container'),
+            ('container', 'c6', 'stale container'),
+            ('image', 'i1', 'bot deleted'),
+            ('image', 'i2', 'bot deleted'),
+            ('image', 'i4', 'dangling image'),
+            ('path', 'user1-bot_1', 'bot deleted'),
+            ('path', 'user1-bot_1.zip', 'bot deleted'),
+            ('path', 'user2-removed_bot', 'archive removed'),
+        ])
+        self.assertListEqual(report['deleted_bots'], ['user1-bot_1'])
+        # Nothing was removed
+        self.assertEqual(report['removed'], 0)
+        self.assertTrue(docker_client.containers.contains('c1'))
+        self.assertTrue(os.path.isdir(os.path.join(self.bots_dir, 'user1-bot_1')))
+
+    def test_collect_removes_orphans(self):
+        self.add_bots()
+        for bot_name in ['user1-bot_1', 'user1-another_bot']:
+            db_session.add(Build(bot_name))
+            db_session.add(BotUsage(bot_name))
+        db_session.commit()
+        docker_client = self.create_docker_client()
+        with patch('deployer.docker_client', new=docker_client):
+            report = self.collector.collect()
+
+        self.assertEqual(report['removed'], 11)
+        self.assertListEqual(report['errors'], [])
+        for container_id in ['c1', 'c2', 'c3', 'c5', 'c6']:
+            self.assertFalse(docker_client.containers.contains(container_id))
+        for image_id in ['i1', 'i2', 'i4']:
+            self.assertFalse(docker_client.images.contains(image_id))
+        self.assertTrue(docker_client.containers.contains('c4'))
+        self.assertTrue(docker_client.containers.contains('c7'))
+        self.assertTrue(docker_client.images.contains('i3'))
+        self.assertTrue(docker_client.images.contains('i5'))
+        self.assertListEqual(sorted(os.listdir(self.bots_dir)),
+                             ['user1-another_bot', 'user1-another_bot.zip', 'user2-old_bot', 'user2-old_bot.zip'])
+        self.assertIsNone(Bot.query.filter_by(name='user1-bot_1').first())
+        # So are the builds and usage of the deleted bot.
+        self.assertEqual([build.bot_name for build in Build.query], ['user1-another_bot'])
+        self.assertEqual([usage.bot_name for usage in BotUsage.query], ['user1-another_bot'])
+
+    def test_collect_keeps_bot_uploaded_again(self):
+        add_bot_record('user1-bot_1', 'user1', status='deleted',
+                       updated_at=datetime.utcnow() - timedelta(minutes=1))
+        self.create_bot_files('user1-bot_1')
+        docker_client = test_docker_client(containers=[], images=[])
+        with patch('deployer.docker_client', new=docker_client):
+            report = self.collector.collect()
+        self.assertListEqual(report['orphans'], [])
+        self.assertListEqual(sorted(os.listdir(self.bots_dir)), ['user1-bot_1', 'user1-bot_1.zip'])
+
+    def test_run_collects_until_stopped(self):
+        reports = [dict(removed=0, errors=[]), dict(removed=1, errors=[])]
+        def collect():
+            if len(reports) == 1:
+                self.collector.stop()
+            return reports.pop(0)
+        self.collector.interval = 0
+        with patch.object(self.collector, 'collect', side_effect=collect) as collect_mock:
+            self.collector.run()
+        self.assertEqual(collect_mock.call_count, 2)
@@ -1,14 +1,32 @@
 from unittest import TestCase
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
 from unittest.mock import patch, MagicMock, Mock, ANY
-from tests.test_lib import test_docker_client, FakeDockerClient
+from tests.test_lib import test_docker_client, FakeDockerClient, FakeDockerAPI, setup_test_db, teardown_test_db, \
+    add_bot_record, setup_test_locks_dir, teardown_test_locks_dir
 
-from docker.errors import ImageNotFound
+from docker.errors import ImageNotFound, DockerException
+from sqlalchemy import create_engine, text
 
+from models import Base, Bot, Build, User, add_missing_columns, db_session
 from naming import get_bot_name, get_bot_image_name
 import deployer
 
 class DeployerTest(TestCase):
 
+    def setUp(self):
+        self.db_engine = setup_test_db()
+        self.locks_dir, self.locks_dir_patch = setup_test_locks_dir()
+
+    def tearDown(self):
+        teardown_test_locks_dir(self.locks_dir, self.locks_dir_patch)
+        teardown_test_db(self.db_engine)
+
     def test_start_bot_success(self):
         docker_client = test_docker_client(
             containers=[
@@ -66,31 +84,44 @@ class DeployerTest(TestCase):
     @patch('builtins.open', return_value=MagicMock())
     def test_delete_bot_success(self, open_mock: ANY):
         bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='running', container_id='c1')
         docker_client = test_docker_client(
             containers=[
-                dict(id='c1', image_id='i1', status='running'),
-                dict(id='c2', image_id='i1', status='exited'),
-                dict(id='c3', image_id='i2', status='paused'),
-                dict(id='c4', image_id='i3', status='running')
+                dict(id='c1', image_id='i1', status='running')
             ],
             images=[
-                dict(id='i1', tags=['zulip-{}'.format(bot_name)]),
-                dict(id='i2', tags=['zulip-{}:latest'.format(bot_name)]),
-                dict(id='i3', tags=['zulip-user1-another_bot:latest'.format(bot_name)])
+                dict(id='i1', tags=['zulip-{}:latest'.format(bot_name)])
             ]
         )
-
+        # Deleting stops the bot and marks it; the garbage collector removes the rest.
         with patch('deployer.docker_client', new=docker_client):
-            deployer.delete_bot(bot_name)
+            self.assertTrue(deployer.delete_bot(bot_name, 'user1'))
+        self.assertEqual(docker_client.containers.get('c1').status, 'exited')
+        self.assertTrue(docker_client.images.contains('i1'))
+        self.assertEqual(Bot.query.filter_by(name=bot_name).one().status, 'deleted')
+        self.assertListEqual(deployer.get_user_bots('user1'), [])
 
-        self.assertFalse(docker_client.containers.contains('c1'))
-        self.assertFalse(docker_client.containers.contains('c2'))
-        self.assertFalse(docker_client.containers.contains('c3'))
-        self.assertFalse(docker_client.images.contains('i1'))
-        self.assertFalse(docker_client.images.contains('i2'))
+    def test_delete_bot_without_record(self):
+        bot_name = 'user1-bot_1'
+        with patch('deployer.docker_client', new=test_docker_client(containers=[], images=[])):
+            self.assertTrue(deployer.delete_bot(bot_name, 'user1'))
+        bot = Bot.query.filter_by(name=bot_name).one()
+        self.assertEqual((bot.owner, bot.status), ('user1', 'deleted'))
 
-        self.assertTrue(docker_client.containers.contains('c4'))
-        self.assertTrue(docker_client.images.contains('i3'))
+    def test_start_deleted_bot(self):
+        bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='deleted')
+        docker_client = test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='created')
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-{}:latest'.format(bot_name)])
+            ]
+        )
+        with patch('deployer.docker_client', new=docker_client):
+            self.assertFalse(deployer.start_bot(bot_name))
+        self.assertEqual(docker_client.containers.get('c1').status, 'created')
 
     def test_bot_log_all_success(self):
         bot_name = 'user1-bot_1'
@@ -149,40 +180,337 @@ class DeployerTest(TestCase):
 
     def test_get_user_bots_success(self):
         user_name = 'user1'
-        bot1_name, bot1_status = get_bot_name(user_name, 'bot1'), 'running'
-        bot2_name, bot2_status = get_bot_name(user_name, 'bot2'), 'paused'
-        bot3_name, bot3_status = get_bot_name(user_name, 'bot3'), 'exited'
-        bot_zuliprc_configs = {
-            bot1_name: dict(email='{}@domain'.format(bot1_name), site='http://{}.com'.format(bot1_name)),
-            bot2_name: dict(email='{}@domain'.format(bot2_name), site='http://{}.com'.format(bot2_name)),
-            bot3_name: dict(email='{}@domain'.format(bot3_name), site='http://{}.com'.format(bot3_name)),
-        }
         bot_name_prefix = get_bot_name(user_name, '')
+        for name, status in [('bot1', 'running'), ('bot2', 'exited'), ('bot3', 'built')]:
+            bot_name = get_bot_name(user_name, name)
+            add_bot_record(bot_name, user_name, status=status,
+                           email='{}@domain'.format(bot_name), site='http://{}.com'.format(bot_name))
+        add_bot_record(get_bot_name('user2', 'bot4'), 'user2', status='running')
+
         expected_bot_configs = [
-            {'name': bot1_name[len(bot_name_prefix):], 'status': bot1_status, **bot_zuliprc_configs[bot1_name]},
-            {'name': bot2_name[len(bot_name_prefix):], 'status': bot2_status, **bot_zuliprc_configs[bot2_name]},
-            {'name': bot3_name[len(bot_name_prefix):], 'status': bot3_status, **bot_zuliprc_configs[bot3_name]},
+            {'name': name, 'status': status,
+             'email': '{}{}@domain'.format(bot_name_prefix, name),
+             'site': 'http://{}{}.com'.format(bot_name_prefix, name)}
+            for name, status in [('bot1', 'running'), ('bot2', 'exited'), ('bot3', 'built')]
         ]
+        # Listing bots reads the catalog only and never talks to Docker.
+        with patch('deployer.docker_client', new=None):
+            actual_bot_configs = deployer.get_user_bots(user_name)
+        self.assertListEqual(actual_bot_configs, expected_bot_configs)
 
+    def test_extract_file_records_bot(self):
+        bot_name = 'user1-bot_1'
+        with tempfile.TemporaryDirectory() as bots_dir:
+            bot_zip_path = os.path.join(bots_dir, bot_name + '.zip')
+            with zipfile.ZipFile(bot_zip_path, 'w') as bot_zip:
+                bot_zip.writestr('config.ini', '[deploy]\nbot=bot.py\nzuliprc=zuliprc\n')
+            with patch('deployer.BOTS_DIR', new=bots_dir):
+                self.assertTrue(deployer.extract_file(bot_name, 'user1'))
+            with open(bot_zip_path, 'rb') as bot_zip:
+                archive_hash = hashlib.sha256(bot_zip.read()).hexdigest()
+        bot = Bot.query.filter_by(name=bot_name).one()
+        self.assertEqual((bot.owner, bot.status, bot.archive_hash), ('user1', 'extracted', archive_hash))
+
+    def test_start_and_stop_bot_update_catalog(self):
+        bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='built')
         docker_client = test_docker_client(
             containers=[
-                dict(id='c1', image_id='i1', status=bot1_status),
-                dict(id='c2', image_id='i2', status=bot2_status),
-                dict(id='c3', image_id='i3', status=bot3_status),
+                dict(id='c1', image_id='i1', status='created')
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-{}:latest'.format(bot_name)])
+            ]
+        )
+        with patch('deployer.docker_client', new=docker_client):
+            deployer.start_bot(bot_name)
+            bot = Bot.query.filter_by(name=bot_name).one()
+            self.assertEqual((bot.status, bot.container_id), ('running', 'c1'))
+            self.assertEqual(docker_client.containers.get('c1').labels, {'botmatrix.bot': bot_name})
+            with patch('builtins.open', return_value=MagicMock()):
+                deployer.stop_bot(bot_name)
+            self.assertEqual(Bot.query.filter_by(name=bot_name).one().status, 'exited')
 
-                dict(id='c4', image_id='i4', status='running'),
+    def test_sync_bot_catalog_adds_old_bots(self):
+        add_bot_record('user1-bot_1', 'user1', status='running', container_id='c1')
+        docker_client = test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='running'),
+                dict(id='c2', image_id='i2', status='exited'),
+                dict(id='c3', image_id='i2', status='running'),
             ],
             images=[
-                dict(id='i1', tags=['{}:latest'.format(get_bot_image_name(bot1_name))]),
-                dict(id='i2', tags=['{}:latest'.format(get_bot_image_name(bot2_name))]),
-                dict(id='i3', tags=['{}:latest'.format(get_bot_image_name(bot3_name))]),
+                dict(id='i1', tags=['zulip-user1-bot_1:latest']),
+                dict(id='i2', tags=['zulip-user-two-bot_2:latest']),
+                dict(id='i3', tags=['zulip-user3-bot_3:latest']),
+            ]
+        )
+        zuliprc = dict(email='bot2-bot@domain', site='https://chat.domain')
+        with patch('deployer.docker_client', new=docker_client), \
+                patch('deployer._read_bot_zuliprc', side_effect=[zuliprc, FileNotFoundError()]):
+            deployer.sync_bot_catalog()
+        bots = {bot.name: bot for bot in Bot.query}
+        self.assertEqual(sorted(bots.keys()), ['user-two-bot_2', 'user1-bot_1', 'user3-bot_3'])
+        bot_2 = bots['user-two-bot_2']
+        self.assertEqual((bot_2.owner, bot_2.status, bot_2.container_id, bot_2.email),
+                         (None, 'running', 'c3', 'bot2-bot@domain'))
+        bot_3 = bots['user3-bot_3']
+        self.assertEqual((bot_3.owner, bot_3.status, bot_3.email), (None, 'built', None))
+        self.assertEqual(bots['user1-bot_1'].owner, 'user1')
 
-                dict(id='i4', tags=['zulip-user2-bot4:latest'])
+    def test_get_user_bots_lists_unowned_bots(self):
+        for username in ['john', 'john-doe']:
+            user = User(username + ' token')
+            user.username = username
+            db_session.add(user)
+        db_session.commit()
+        add_bot_record('john-bot', None, status='built')
+        add_bot_record('john-doe-bot', None, status='running')
+        add_bot_record('johnny-bot', None, status='built')
+        list_names = lambda username: [bot['name'] for bot in deployer.get_user_bots(username)]
+        self.assertEqual(list_names('john'), ['bot'])
+        self.assertEqual(list_names('john-doe'), ['bot'])
+        # Processing or deleting a bot claims it for the user.
+        deployer._update_bot_record('john-doe-bot', owner='john', status='extracted')
+        self.assertEqual(list_names('john'), ['bot', 'doe-bot'])
+        self.assertEqual(list_names('john-doe'), [])
+
+    def test_sync_bot_statuses_marks_stopped_bots(self):
+        add_bot_record('user1-bot_1', 'user1', status='running', container_id='c1')
+        add_bot_record('user1-bot_2', 'user1', status='running', container_id='c2')
+        add_bot_record('user1-bot_3', 'user1', status='running', container_id='c3')
+        docker_client = test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='exited'),
+                dict(id='c2', image_id='i2', status='running'),
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-user1-bot_1:latest']),
+                dict(id='i2', tags=['zulip-user1-bot_2:latest']),
             ]
         )
         with patch('deployer.docker_client', new=docker_client):
-            read_bot_zuliprc_mock = lambda bot_name: bot_zuliprc_configs[bot_name]
-            with patch('deployer._read_bot_zuliprc', new=read_bot_zuliprc_mock):
-                actual_bot_configs = deployer.get_user_bots(user_name)
-            bot_config_key = lambda bot_config: bot_config['name']
-            self.assertListEqual(sorted(actual_bot_configs, key=bot_config_key), sorted(expected_bot_configs, key=bot_config_key))
+            # bot_2 was started after the running containers were listed.
+            deployer.sync_bot_statuses(dict())
+        statuses = {bot.name: bot.status for bot in Bot.query}
+        self.assertEqual(statuses, {'user1-bot_1': 'exited', 'user1-bot_2': 'running',
+                                    'user1-bot_3': 'exited'})
+
+    def test_get_user_bots_version_changes_with_catalog(self):
+        empty_version = deployer.get_user_bots_version('user1')
+        add_bot_record('user1-bot_1', 'user1', status='built')
+        version = deployer.get_user_bots_version('user1')
+        self.assertNotEqual(version, empty_version)
+        add_bot_record('user2-bot_1', 'user2', status='built')
+        self.assertEqual(deployer.get_user_bots_version('user1'), version)
+        # Updates within the same clock tick still change the version.
+        for status in ['running', 'exited']:
+            deployer._update_bot_record('user1-bot_1', status=status)
+            self.assertNotEqual(deployer.get_user_bots_version('user1'), version)
+            version = deployer.get_user_bots_version('user1')
+
+    def test_get_user_bots_version_never_repeats(self):
+        add_bot_record('user1-bot_1', 'user1', status='built')
+        versions = [deployer.get_user_bots_version('user1')]
+        add_bot_record('user1-bot_2', 'user1', status='built')
+        versions.append(deployer.get_user_bots_version('user1'))
+        # The collector removes bot_2, after which SQLite may reuse its id.
+        Bot.query.filter_by(name='user1-bot_2').delete()
+        deployer.bump_catalog_version('user1')
+        db_session.commit()
+        versions.append(deployer.get_user_bots_version('user1'))
+        add_bot_record('user1-bot_2', 'user1', status='built')
+        versions.append(deployer.get_user_bots_version('user1'))
+        self.assertEqual(len(set(versions)), len(versions))
+        # Claiming an unowned bot changes the lists it leaves and joins.
+        add_bot_record('user1-old_bot', None, status='built')
+        version = deployer.get_user_bots_version('user1')
+        deployer._update_bot_record('user1-old_bot', owner='user1', status='extracted')
+        self.assertNotEqual(deployer.get_user_bots_version('user1').split(':')[1], version.split(':')[1])
+        self.assertEqual(Bot.query.filter_by(name='user1-old_bot').one().version,
+                         int(deployer.get_user_bots_version('user1').split(':')[0]))
+
+    def test_add_missing_columns(self):
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE bots (id INTEGER PRIMARY KEY, name VARCHAR(200), '
+                                    'owner VARCHAR(200))'))
+            connection.execute(text("INSERT INTO bots (name, owner) VALUES ('user1-bot_1', 'user1')"))
+        Base.metadata.create_all(bind=engine)
+        add_missing_columns(engine)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT version, status FROM bots')).fetchall(), [(0, None)])
+        engine.dispose()
+
+    def test_get_bot_log_version(self):
+        add_bot_record('user1-bot_1', 'user1', status='running', container_id='c1')
+        add_bot_record('user1-bot_2', 'user1', status='exited', container_id='c2')
+        self.assertIsNone(deployer.get_bot_log_version('user1-bot_1'))
+        self.assertIsNone(deployer.get_bot_log_version('user1-unknown'))
+        version = deployer.get_bot_log_version('user1-bot_2')
+        self.assertTrue(version.startswith('c2:exited:'))
+        with patch('deployer.docker_client', new=test_docker_client(containers=[], images=[])):
+            deployer.delete_bot('user1-bot_2', 'user1')
+        self.assertNotEqual(deployer.get_bot_log_version('user1-bot_2'), version)
+
+    def create_bot_root(self, bots_dir, bot_name):
+        bot_root = os.path.join(bots_dir, bot_name)
+        os.mkdir(bot_root)
+        with open(os.path.join(bot_root, 'config.ini'), 'w') as config_file:
+            config_file.write('[deploy]\nbot=bot.py\nzuliprc=zuliprc\n')
+        with open(os.path.join(bot_root, 'zuliprc'), 'w') as zuliprc_file:
+            zuliprc_file.write('[api]\nemail=bot@domain\nkey=secret\nsite=http://domain.com\n')
+        return bot_root
+
+    def test_stream_docker_image_build_success(self):
+        bot_name = 'user1-bot_1'
+        bot = add_bot_record(bot_name, 'user1', status='extracted')
+        build_output = [
+            dict(stream='Step 1/6 : FROM python:3\n'),
+            dict(stream=' ---> 1234\nStep 2/6 : RUN pip install zulip zulip-bots zulip-botserver\n'),
+            dict(stream='Step 3/6 : ADD ./* bot/\n'),
+            dict(stream='Step 4/6 : RUN pip install -r bot/requirements.txt\n'),
+            dict(aux=dict(ID='sha256:abcd')),
+            dict(stream='Successfully built abcd\n'),
+        ]
+        docker_client = test_docker_client(containers=[], images=[])
+        docker_client.api = FakeDockerAPI(build_output)
+        with tempfile.TemporaryDirectory() as bots_dir:
+            bot_root = self.create_bot_root(bots_dir, bot_name)
+            with patch('deployer.BOTS_DIR', new=bots_dir), patch('deployer.docker_client', new=docker_client):
+                lines = list(deployer.stream_docker_image_build(bot_name))
+            with open(os.path.join(bot_root, deployer.BUILD_LOG_FILE)) as build_log:
+                self.assertEqual(build_log.read(), ''.join(lines))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1], ' ---> 1234\n')
+        # The caller's session is left to the caller.
+        self.assertIn(bot, db_session)
+        self.assertEqual((bot.status, bot.image_id, bot.email, bot.site),
+                         ('built', 'sha256:abcd', 'bot@domain', 'http://domain.com'))
+        build = Build.query.filter_by(bot_name=bot_name).one()
+        self.assertTrue(build.success)
+        self.assertEqual(sorted(json.loads(build.stages).keys()),
+                         ['base_install', 'base_pull', 'context', 'pip_install', 'source_add'])
+
+    def test_stream_docker_image_build_failure(self):
+        bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='extracted')
+        build_output = [
+            dict(stream='Step 1/6 : FROM python:3\n'),
+            dict(error='No matching distribution found for missing-package\n'),
+        ]
+        docker_client = test_docker_client(containers=[], images=[])
+        docker_client.api = FakeDockerAPI(build_output)
+        with tempfile.TemporaryDirectory() as bots_dir:
+            self.create_bot_root(bots_dir, bot_name)
+            with patch('deployer.BOTS_DIR', new=bots_dir), patch('deployer.docker_client', new=docker_client):
+                with self.assertRaisesRegex(deployer.BuildError, 'missing-package'):
+                    deployer.create_docker_image(bot_name)
+        self.assertFalse(Build.query.filter_by(bot_name=bot_name).one().success)
+        self.assertEqual(Bot.query.filter_by(name=bot_name).one().status, 'extracted')
+
+    def test_stream_docker_image_build_closed_early(self):
+        bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='extracted')
+        build_output = [
+            dict(stream='Step 1/6 : FROM python:3\n'),
+            dict(stream='Step 2/6 : RUN pip install zulip zulip-bots zulip-botserver\n'),
+        ]
+        docker_client = test_docker_client(containers=[], images=[])
+        docker_client.api = FakeDockerAPI(build_output)
+        with tempfile.TemporaryDirectory() as bots_dir:
+            self.create_bot_root(bots_dir, bot_name)
+            with patch('deployer.BOTS_DIR', new=bots_dir), patch('deployer.docker_client', new=docker_client):
+                lines = deployer.stream_docker_image_build(bot_name)
+                self.assertEqual(next(lines), 'Step 1/6 : FROM python:3\n')
+                # The client disconnected.
+                lines.close()
+                self.assertEqual(deployer.get_build_log(bot_name), 'Step 1/6 : FROM python:3\n')
+        self.assertTrue(docker_client.api.closed)
+        self.assertFalse(Build.query.filter_by(bot_name=bot_name).one().success)
+        self.assertEqual(Bot.query.filter_by(name=bot_name).one().status, 'extracted')
+
+    def test_running_bot_extracted_until_build_stops_it(self):
+        bot_name = 'user1-bot_1'
+        add_bot_record(bot_name, 'user1', status='running', container_id='c1')
+        docker_client = test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='running'),
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-{}:latest'.format(bot_name)]),
+            ]
+        )
+        docker_client.api = FakeDockerAPI([dict(error='Broken requirements.txt\n')])
+        with tempfile.TemporaryDirectory() as bots_dir:
+            self.create_bot_root(bots_dir, bot_name)
+            with zipfile.ZipFile(os.path.join(bots_dir, bot_name + '.zip'), 'w') as bot_zip:
+                bot_zip.writestr('config.ini', '[deploy]\nbot=bot.py\nzuliprc=zuliprc\n')
+            with patch('deployer.BOTS_DIR', new=bots_dir), patch('deployer.docker_client', new=docker_client):
+                self.assertTrue(deployer.extract_file(bot_name, 'user1'))
+                # The old version still runs.
+                bot = Bot.query.filter_by(name=bot_name).one()
+                self.assertEqual((bot.status, bot.container_id), ('running', 'c1'))
+                with self.assertRaises(deployer.BuildError):
+                    deployer.create_docker_image(bot_name)
+        self.assertEqual(docker_client.containers.get('c1').status, 'exited')
+        bot = Bot.query.filter_by(name=bot_name).one()
+        self.assertEqual((bot.status, bot.container_id), ('extracted', None))
+
+    def test_get_build_log_not_found(self):
+        with tempfile.TemporaryDirectory() as bots_dir:
+            with patch('deployer.BOTS_DIR', new=bots_dir):
+                self.assertIsNone(deployer.get_build_log('user1-bot_1'))
+
+    def test_build_timer(self):
+        now = [0.0]
+        timer = deployer.BuildTimer(clock=lambda: now[0])
+        for elapsed, line in [(1.0, 'Step 1/3 : FROM python:3'),
+                              (10.0, ' ---> 1234'),
+                              (2.0, 'Step 2/3 : RUN pip install -r bot/requirements.txt'),
+                              (30.0, 'Step 3/3 : CMD [ "zulip-run-bot" ]')]:
+            now[0] += elapsed
+            timer.feed(line)
+        now[0] += 0.5
+        self.assertEqual(timer.finish(), 43.5)
+        self.assertEqual(timer.stages, dict(context=1.0, base_pull=12.0, pip_install=30.0, other=0.5))
+
+    def test_get_build_report(self):
+        add_bot_record('user1-fast', 'user1')
+        add_bot_record('user1-slow', 'user1')
+        add_bot_record('user1-other-bot', 'user1-other')
+        for bot_name, pip_install, success in [('user1-fast', 1.0, True), ('user1-slow', 50.0, True),
+                                               ('user1-slow', 30.0, True), ('user1-slow', 5.0, False),
+                                               ('user1-other-bot', 100.0, True)]:
+            build = Build(bot_name)
+            build.duration = pip_install + 10.0
+            build.success = success
+            build.stages = json.dumps(dict(pip_install=pip_install))
+            db_session.add(build)
+        db_session.commit()
+        report = deployer.get_build_report('user1')
+        self.assertListEqual(report, [
+            dict(name='slow', builds=3, failures=1, duration=50.0, stages=dict(pip_install=40.0)),
+            dict(name='fast', builds=1, failures=0, duration=11.0, stages=dict(pip_install=1.0)),
+        ])
+
+    def test_get_docker_client_reconnects(self):
+        broken_client = MagicMock()
+        broken_client.ping.side_effect = DockerException('Connection refused')
+        new_client = MagicMock()
+        with patch('deployer.docker_client', new=broken_client), \
+                patch('deployer._docker_client_checked_at', new=0.0), \
+                patch('docker.from_env', return_value=new_client) as from_env:
+            self.assertIs(deployer.get_docker_client(), new_client)
+            # The healthy client is reused without another check.
+            self.assertIs(deployer.get_docker_client(), new_client)
+        broken_client.close.assert_called_once_with()
+        from_env.assert_called_once_with(max_pool_size=ANY)
+        new_client.ping.assert_not_called()
+
+    def test_import_without_docker_daemon(self):
+        root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, DOCKER_HOST='unix:///nonexistent/docker.sock')
+        result = subprocess.run([sys.executable, '-c', 'import app, ingest'],
+                                cwd=root_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 0, result.stderr.decode('utf-8'))
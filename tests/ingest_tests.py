@@ -0,0 +1,276 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+
+import requests
+
+from tests.test_lib import setup_test_db, teardown_test_db, setup_test_locks_dir, teardown_test_locks_dir
+
+from models import User, db_session
+from ratelimit import RateLimiter
+import ingest
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeZulipHandler(BaseHTTPRequestHandler):
+    """Serves the uploads and the event queue of a stand-in Zulip server."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def is_authorized(self):
+        expected = 'Basic ' + base64.b64encode(b'ingest-bot@domain:secret').decode('ascii')
+        if self.headers.get('Authorization') != expected:
+            self.send_error(401)
+            return False
+        return True
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.is_authorized():
+            return
+        if self.path.startswith('/api/v1/events'):
+            if self.server.failures:
+                self.send_error(self.server.failures.pop(0))
+                return
+            self.send_json(dict(events=self.server.events))
+            return
+        content = self.server.uploads.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        # Without Content-Length the size limit has to be enforced while streaming.
+        if not self.server.chunked:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        if not self.is_authorized():
+            return
+        self.server.registrations += 1
+        self.send_json(dict(queue_id='q1', last_event_id=-1))
+
+def zip_archive(files):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        for name, content in files.items():
+            zip_file.writestr(name, content)
+    return archive.getvalue()
+
+class BotIngestorTest(TestCase):
+
+    def setUp(self):
+        self.db_engine = setup_test_db()
+        self.user = User('token')
+        self.user.username = 'user1'
+        self.user.zulip_email = 'user1@domain'
+        db_session.add(self.user)
+        db_session.commit()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeZulipHandler)
+        self.server.uploads = {
+            '/user_uploads/1/ab/bot1.zip': b'bot1 archive',
+            '/user_uploads/1/cd/bot2.zip': b'bot2 archive' * 10,
+            '/user_uploads/1/ef/bot3.zip': b'not a zip file',
+            '/user_uploads/1/gh/bot4.zip': zip_archive({'bot.py': 'pass\n'}),
+        }
+        self.server.events = []
+        self.server.failures = []
+        self.server.registrations = 0
+        self.server.chunked = False
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.bots_dir = tempfile.TemporaryDirectory()
+        self.bots_dir_patch = patch('deployer.BOTS_DIR', new=self.bots_dir.name)
+        self.bots_dir_patch.start()
+        self.locks_dir, self.locks_dir_patch = setup_test_locks_dir()
+        self.limiter_patch = patch('ratelimit.limiter', new=RateLimiter(
+            path=os.path.join(self.bots_dir.name, '.ratelimit.db'), rate=1.0, capacity=1000))
+        self.limiter_patch.start()
+        site = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.sleep = MagicMock()
+        self.ingestor = ingest.BotIngestor(site, 'ingest-bot@domain', 'secret', workers=2, max_size=100,
+                                           sleep=self.sleep)
+
+    def tearDown(self):
+        self.ingestor.close()
+        self.limiter_patch.stop()
+        teardown_test_locks_dir(self.locks_dir, self.locks_dir_patch)
+        self.bots_dir_patch.stop()
+        self.bots_dir.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        teardown_test_db(self.db_engine)
+
+    def bot_message(self, content, sender='user1@domain', type='private'):
+        return dict(content=content, sender_email=sender, type=type)
+
+    def test_parse_bot_uploads(self):
+        message = self.bot_message('Deploy [bot1.zip](/user_uploads/1/ab/bot1.zip) and '
+                                   '[notes.txt](/user_uploads/1/ef/notes.txt), '
+                                   '[bot2.zip](https://example.com/bot2.zip)')
+        self.assertListEqual(ingest.parse_bot_uploads(message, self.user), [
+            dict(bot_name='user1-bot1', owner='user1', user_id=self.user.id, ext='.zip',
+                 path='/user_uploads/1/ab/bot1.zip'),
+        ])
+
+    def test_parse_bot_uploads_rejects_other_paths(self):
+        paths = [
+            '/user_uploads/../api/v1/messages?anchor=newest',
+            '/user_uploads/1/ab/../../../api/v1/users',
+            '/user_uploads/1/ab/%2e%2e',
+            '/user_uploads/1/ab/bot.zip?anchor=newest',
+            '/user_uploads/1/ab/bot.zip#bot.zip',
+            '/user_uploads/1/bot.zip',
+            '/user_uploads/x/ab/bot.zip',
+        ]
+        message = self.bot_message(' '.join('[x.zip]({})'.format(path) for path in paths))
+        self.assertListEqual(ingest.parse_bot_uploads(message, self.user), [])
+        for path in paths:
+            with self.assertRaises(ingest.DownloadError):
+                self.ingestor.download(path, 'user1-x.zip')
+        self.assertListEqual(os.listdir(self.bots_dir.name), [])
+
+    def test_download(self):
+        path = self.ingestor.download('/user_uploads/1/ab/bot1.zip', 'user1-bot1.zip')
+        self.assertEqual(path, os.path.join(self.bots_dir.name, 'user1-bot1.zip'))
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'bot1 archive')
+
+    def test_download_too_large(self):
+        for chunked in [False, True]:
+            self.server.chunked = chunked
+            with self.assertRaises(ingest.DownloadError):
+                self.ingestor.download('/user_uploads/1/cd/bot2.zip', 'user1-bot2.zip')
+            self.assertListEqual(os.listdir(self.bots_dir.name), [])
+
+    def test_handle_messages(self):
+        messages = [
+            self.bot_message('[bot1.zip](/user_uploads/1/ab/bot1.zip)'),
+            self.bot_message('[bot2.zip](/user_uploads/1/cd/bot2.zip)'),
+            self.bot_message('[bot3.zip](/user_uploads/1/xx/missing.zip)'),
+            self.bot_message('Just chatting'),
+            self.bot_message('[bot5.zip](/user_uploads/1/ab/bot1.zip)', sender='stranger@domain'),
+        ]
+        with patch('deployer.extract_file', return_value=True) as extract_file, \
+                patch('deployer.check_and_load_structure', return_value=True), \
+                patch('deployer.create_docker_image') as create_docker_image:
+            results = self.ingestor.handle_messages(messages)
+
+        self.assertEqual([(result['name'], result['status']) for result in results], [
+            ('user1-bot1', 'success'),
+            ('user1-bot2', 'error'),
+            ('user1-bot3', 'error'),
+        ])
+        # Uploads of senders who aren't botmatrix users are ignored.
+        extract_file.assert_called_once_with('user1-bot1', 'user1')
+        create_docker_image.assert_called_once_with('user1-bot1')
+        self.assertTrue(os.path.isfile(os.path.join(self.bots_dir.name, 'user1-bot1.zip')))
+
+    def test_link_zulip_email(self):
+        user = User('other token')
+        user.username = 'user2'
+        user.zulip_link_token = 'c0ffee'
+        db_session.add(user)
+        db_session.commit()
+        user_ids = (self.user.id, user.id)
+        messages = [
+            # Wrong tokens and tokens posted to streams link nothing.
+            self.bot_message('link bad', sender='user1@domain'),
+            self.bot_message('link c0ffee', sender='stranger@domain', type='stream'),
+            self.bot_message('link c0ffee', sender='user1@domain'),
+            self.bot_message('[bot1.zip](/user_uploads/1/ab/bot1.zip)', sender='user1@domain'),
+        ]
+        with patch.object(self.ingestor, 'deploy_upload',
+                          side_effect=lambda upload: dict(name=upload['bot_name'], status='success')):
+            results = self.ingestor.handle_messages(messages)
+        # The email now belongs to user2, who sent the token from it.
+        self.assertEqual([result['name'] for result in results], ['user2-bot1'])
+        self.assertEqual([(user.id, user.zulip_email, user.zulip_link_token) for user in User.query.order_by(User.id)],
+                         [(user_ids[0], None, None), (user_ids[1], 'user1@domain', None)])
+        # The token can only be used once.
+        self.ingestor.handle_messages([self.bot_message('link c0ffee', sender='stranger@domain')])
+        self.assertIsNone(User.query.filter_by(zulip_email='stranger@domain').first())
+
+    def test_handle_messages_with_broken_archives(self):
+        self.ingestor.max_size = 1000
+        messages = [
+            self.bot_message('[bot3.zip](/user_uploads/1/ef/bot3.zip)'),
+            self.bot_message('[bot4.zip](/user_uploads/1/gh/bot4.zip)'),
+        ]
+        with patch('deployer.create_docker_image') as create_docker_image:
+            results = self.ingestor.handle_messages(messages)
+        self.assertEqual([(result['name'], result['status']) for result in results], [
+            ('user1-bot3', 'error'),
+            ('user1-bot4', 'error'),
+        ])
+        self.assertIn('not a zip file', results[0]['message'])
+        self.assertIn('config.ini', results[1]['message'])
+        create_docker_image.assert_not_called()
+
+    def test_run_consumes_event_batches(self):
+        self.server.events = [
+            dict(id=0, type='message', message=self.bot_message('[bot1.zip](/user_uploads/1/ab/bot1.zip)')),
+            dict(id=1, type='heartbeat'),
+        ]
+        with patch.object(self.ingestor, 'deploy_upload',
+                          return_value=dict(name='user1-bot1', status='success')) as deploy_upload:
+            self.ingestor.run(batches=1)
+            # Uploads are deployed in the background.
+            self.ingestor.executor.shutdown()
+        deploy_upload.assert_called_once_with(dict(bot_name='user1-bot1', owner='user1', user_id=self.user.id,
+                                                   ext='.zip', path='/user_uploads/1/ab/bot1.zip'))
+
+    def test_run_retries_failed_polls(self):
+        self.server.events = [
+            dict(id=0, type='message', message=self.bot_message('[bot1.zip](/user_uploads/1/ab/bot1.zip)')),
+        ]
+        # The server fails, restarts and loses the event queue.
+        self.server.failures = [502, 503, 400]
+        session_get = self.ingestor.session.get
+        errors = [requests.ConnectionError('Connection refused')]
+        def get(*args, **kwargs):
+            if errors:
+                raise errors.pop(0)
+            return session_get(*args, **kwargs)
+        with patch.object(self.ingestor.session, 'get', side_effect=get), \
+                patch.object(self.ingestor, 'deploy_upload',
+                             return_value=dict(name='user1-bot1', status='success')) as deploy_upload:
+            self.ingestor.run(batches=1)
+            self.ingestor.executor.shutdown()
+        deploy_upload.assert_called_once()
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [1, 2, 4])
+        self.assertEqual(self.server.registrations, 2)
+
+    def test_run_fails_on_client_errors(self):
+        self.server.failures = [401]
+        with self.assertRaises(requests.HTTPError):
+            self.ingestor.run(batches=1)
+        self.sleep.assert_not_called()
+
+    def test_deploy_upload_rate_limited(self):
+        upload = dict(bot_name='user1-bot1', owner='user1', user_id=self.user.id, ext='.zip',
+                      path='/user_uploads/1/ab/bot1.zip')
+        limiter = RateLimiter(path=os.path.join(self.bots_dir.name, '.limited.db'), rate=0.01, capacity=50)
+        with patch('ratelimit.limiter', new=limiter), \
+                patch('deployer.extract_file', return_value=False):
+            self.assertEqual(self.ingestor.deploy_upload(upload)['message'], "Failure. Bot zip file not found.")
+            self.assertEqual(self.ingestor.deploy_upload(upload)['message'], "Failure. Rate limit exceeded.")
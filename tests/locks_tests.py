@@ -0,0 +1,50 @@
+from unittest import TestCase
+import threading
+import time
+
+from tests.test_lib import setup_test_locks_dir, teardown_test_locks_dir
+
+import locks
+
+class BotLockTest(TestCase):
+
+    def setUp(self):
+        self.locks_dir, self.locks_dir_patch = setup_test_locks_dir()
+        locks.metrics.reset()
+
+    def tearDown(self):
+        teardown_test_locks_dir(self.locks_dir, self.locks_dir_patch)
+
+    def run_in_threads(self, bot_names, hold_time):
+        events = []
+        def operation(bot_name):
+            with locks.bot_lock(bot_name, 'test'):
+                events.append(('enter', bot_name))
+                time.sleep(hold_time)
+                events.append(('exit', bot_name))
+        threads = [threading.Thread(target=operation, args=(bot_name,)) for bot_name in bot_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return events
+
+    def test_same_bot_is_serialized(self):
+        events = self.run_in_threads(['user1-bot_1', 'user1-bot_1'], hold_time=0.05)
+        self.assertEqual([event for event, _ in events], ['enter', 'exit', 'enter', 'exit'])
+        metrics = locks.metrics.get()['test']
+        self.assertEqual(metrics['count'], 2)
+        self.assertGreater(metrics['wait_max'], 0.0)
+
+    def test_different_bots_run_in_parallel(self):
+        events = self.run_in_threads(['user1-bot_1', 'user1-bot_2'], hold_time=0.05)
+        self.assertEqual([event for event, _ in events[:2]], ['enter', 'enter'])
+
+    def test_lock_is_reentrant(self):
+        @locks.locked('inner')
+        def inner(bot_name):
+            return bot_name
+
+        with locks.bot_lock('user1-bot_1', 'outer'):
+            self.assertEqual(inner('user1-bot_1'), 'user1-bot_1')
+        self.assertListEqual(list(locks.metrics.get().keys()), ['outer'])
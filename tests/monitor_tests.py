@@ -0,0 +1,104 @@
+from unittest import TestCase
+from unittest.mock import patch
+from tests.test_lib import test_docker_client, setup_test_db, teardown_test_db, add_bot_record
+
+import monitor
+
+def container_stats(total_usage, system_usage, memory_usage, cache=0):
+    return dict(
+        cpu_stats=dict(cpu_usage=dict(total_usage=total_usage), system_cpu_usage=system_usage, online_cpus=2),
+        memory_stats=dict(usage=memory_usage, stats=dict(cache=cache)),
+    )
+
+class UsageHistoryTest(TestCase):
+
+    def test_ring_buffer_keeps_latest_samples(self):
+        history = monitor.UsageHistory(3)
+        for i in range(5):
+            history.add(float(i), float(i * 10), float(i * 100))
+        self.assertEqual(history.count, 3)
+        self.assertEqual(history.samples(), [(2.0, 20.0, 200.0), (3.0, 30.0, 300.0), (4.0, 40.0, 400.0)])
+        summary = history.summary()
+        self.assertEqual(summary['cpu'], dict(last=40.0, avg=30.0, max=40.0))
+        self.assertEqual(summary['memory']['last'], 400.0)
+
+    def test_empty_summary(self):
+        self.assertEqual(monitor.UsageHistory(3).summary(), dict(samples=0))
+
+class ResourceSamplerTest(TestCase):
+
+    def setUp(self):
+        self.db_engine = setup_test_db()
+
+    def tearDown(self):
+        teardown_test_db(self.db_engine)
+
+    def test_sample_once_records_running_bots(self):
+        docker_client = test_docker_client(
+            containers=[
+                dict(id='c1', image_id='i1', status='running',
+                     stats=container_stats(100, 1000, 2048)),
+                dict(id='c2', image_id='i2', status='exited'),
+                dict(id='c3', image_id='i3', status='running'),
+            ],
+            images=[
+                dict(id='i1', tags=['zulip-user1-bot_1:latest']),
+                dict(id='i2', tags=['zulip-user1-bot_2:latest']),
+                dict(id='i3', tags=['postgres:latest']),
+            ]
+        )
+        add_bot_record('user1-bot_1', 'user1', status='running', container_id='c1')
+        sampler = monitor.ResourceSampler(interval=1, history_size=4, max_bots=10, workers=2)
+        with patch('deployer.docker_client', new=docker_client):
+            # The first stats are only the baseline for the CPU usage.
+            sampler.sample_once()
+            self.assertEqual(monitor.get_bot_usage('user1'), dict())
+            docker_client.containers.get('c1')._stats = container_stats(150, 1200, 4096, cache=1024)
+            sampler.sample_once()
+        sampler.stop()
+        usage = monitor.get_bot_usage('user1')
+        self.assertListEqual(list(usage.keys()), ['user1-bot_1'])
+        self.assertEqual(usage['user1-bot_1']['samples'], 1)
+        self.assertEqual(usage['user1-bot_1']['cpu']['last'], 50.0)
+        self.assertEqual(usage['user1-bot_1']['memory']['last'], 3072.0)
+
+    def test_cpu_usage_after_restart(self):
+        sampler = monitor.ResourceSampler(interval=1, history_size=4, max_bots=10, workers=1)
+        sampler.record_stats('user1-bot_1', 1.0, container_stats(500, 1000, 0))
+        sampler.record_stats('user1-bot_1', 2.0, container_stats(10, 1200, 0))
+        self.assertEqual(sampler.get_bot_history('user1-bot_1'), [(2.0, 0.0, 0.0)])
+
+    def test_store_usage_replaces_stored_summaries(self):
+        sampler = monitor.ResourceSampler(interval=1, history_size=2, max_bots=1, workers=1)
+        sampler.record('user1-bot_1', 1.0, 5.0, 100.0)
+        sampler.store_usage()
+        sampler.record('user1-bot_2', 2.0, 7.0, 200.0)
+        sampler.store_usage()
+        usage = monitor.get_bot_usage()
+        self.assertListEqual(list(usage.keys()), ['user1-bot_2'])
+        self.assertEqual(usage['user1-bot_2']['cpu'], dict(last=7.0, avg=7.0, max=7.0))
+
+    def test_get_bot_usage_of_owner(self):
+        add_bot_record('john-bot', 'john')
+        add_bot_record('john-doe-bot', 'john-doe')
+        sampler = monitor.ResourceSampler(interval=1, history_size=2, max_bots=10, workers=1)
+        sampler.record('john-bot', 1.0, 5.0, 100.0)
+        sampler.record('john-doe-bot', 1.0, 7.0, 200.0)
+        sampler.store_usage()
+        self.assertListEqual(list(monitor.get_bot_usage('john').keys()), ['john-bot'])
+        self.assertListEqual(list(monitor.get_bot_usage('john-doe').keys()), ['john-doe-bot'])
+
+    def test_history_is_bounded_by_max_bots(self):
+        sampler = monitor.ResourceSampler(interval=1, history_size=2, max_bots=2, workers=1)
+        sampler.record('user1-bot_1', 1.0, 1.0, 1.0)
+        sampler.record('user1-bot_2', 1.0, 1.0, 1.0)
+        sampler.record('user1-bot_1', 2.0, 1.0, 1.0)
+        sampler.record('user1-bot_3', 2.0, 1.0, 1.0)
+        self.assertListEqual(sorted(sampler.get_bot_usage().keys()), ['user1-bot_1', 'user1-bot_3'])
+
+    def test_summarize_usage_ignores_stale_bots(self):
+        sampler = monitor.ResourceSampler(interval=1, history_size=2, max_bots=10, workers=1)
+        sampler.record('user1-bot_1', 10.0, 5.0, 100.0)
+        sampler.record('user1-bot_2', 20.0, 7.0, 200.0)
+        summary = monitor.summarize_usage(sampler.get_bot_usage('user1-'), active_since=15.0)
+        self.assertEqual(summary, dict(bots=2, active=1, cpu=7.0, memory=200.0))
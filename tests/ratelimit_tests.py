@@ -0,0 +1,63 @@
+from unittest import TestCase
+import os
+import tempfile
+
+from ratelimit import RateLimiter, retry_after_header
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class RateLimiterTest(TestCase):
+
+    def setUp(self):
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.limiter = self.create_limiter()
+
+    def tearDown(self):
+        self.db_dir.cleanup()
+
+    def create_limiter(self):
+        return RateLimiter(path=os.path.join(self.db_dir.name, 'ratelimit.db'),
+                           rate=2.0, capacity=10, max_concurrent=2,
+                           operation_timeout=60, clock=self.clock)
+
+    def test_consume_until_empty_then_refill(self):
+        self.assertEqual(self.limiter.consume('key1', 6), 0)
+        self.assertEqual(self.limiter.consume('key1', 6), 1.0)
+        # Other keys have their own bucket
+        self.assertEqual(self.limiter.consume('key2', 6), 0)
+        self.clock.now += 1.0
+        self.assertEqual(self.limiter.consume('key1', 6), 0)
+
+    def test_db_file_is_private(self):
+        self.limiter.consume('key1', 1)
+        self.assertEqual(os.stat(self.limiter.path).st_mode & 0o777, 0o600)
+
+    def test_state_is_shared_between_limiters(self):
+        self.assertEqual(self.limiter.consume('key1', 10), 0)
+        self.assertGreater(self.create_limiter().consume('key1', 1), 0)
+
+    def test_concurrent_operations_cap(self):
+        first = self.limiter.acquire('key1')
+        second = self.limiter.acquire('key1')
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.limiter.acquire('key1'))
+        self.assertIsNotNone(self.limiter.acquire('key2'))
+        self.limiter.release(first)
+        self.assertIsNotNone(self.limiter.acquire('key1'))
+
+    def test_stale_operations_expire(self):
+        self.limiter.acquire('key1')
+        self.limiter.acquire('key1')
+        self.clock.now += 61
+        self.assertIsNotNone(self.limiter.acquire('key1'))
+
+    def test_retry_after_header(self):
+        self.assertEqual(retry_after_header(0.2), '1')
+        self.assertEqual(retry_after_header(2.5), '3')
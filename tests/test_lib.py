@@ -1,19 +1,31 @@
 from typing import List, Dict, Any
+from unittest.mock import patch
+import tempfile
 
-from docker.errors import ImageNotFound
+from docker.errors import ImageNotFound, NotFound
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from deployer import bump_catalog_version
+from models import Base, Bot, db_session
 
 class DockerError(Exception):
     def __init__(self, msg):
         super(DockerError, self).__init__(msg)
 
 class DockerImage:
-    def __init__(self, id: str, tags: List[str]):
+    def __init__(self, id: str, tags: List[str], labels=None):
         self.id = id
+        self.short_id = id
         self.tags = tags
+        self.labels = labels or {}
 
 class DockerImages:
     def __init__(self, images: List[DockerImage]):
-        self.images = images
+        self.images = list(images)
+
+    def list(self):
+        return list(self.images)
 
     def remove(self, image, force):
         self.images = [docker_image for docker_image in self.images if docker_image.id != image]
@@ -22,12 +34,15 @@ class DockerImages:
         return image_id in [image.id for image in self.images]
 
 class DockerContainer:
-    def __init__(self, id: str, image: DockerImage, status: str, logs=''):
+    def __init__(self, id: str, image: DockerImage, status: str, logs='', stats=None, labels=None):
         self.id = id
         self.short_id = id
         self.image = image
         self.status = status
+        self.labels = labels or {}
+        self.attrs = dict(Image=image.id)
         self._logs = logs
+        self._stats = stats or {}
 
     def setOwner(self, owner):
         self._owner = owner
@@ -38,6 +53,9 @@ class DockerContainer:
     def logs(self):
         return bytearray(self._logs, 'utf-8')
 
+    def stats(self, stream, one_shot=False):
+        return self._stats
+
     def stop(self):
         self.status = 'exited'
 
@@ -54,7 +72,10 @@ class DockerContainers:
         return [container for container in self.containers if all or container.is_running()]
 
     def get(self, container_id):
-        return next(container for container in self.containers if container.id == container_id)
+        for container in self.containers:
+            if container.id == container_id:
+                return container
+        raise NotFound('No such container: {}'.format(container_id))
 
     def contains(self, container_id):
         return container_id in [container.id for container in self.containers]
@@ -66,6 +87,7 @@ class DockerContainers:
                     if container.status == 'running':
                         raise DockerError('Container is already running')
                     container.status = 'running'
+                    container.labels = kwargs.get('labels', {})
                     return container
         raise ImageNotFound('Image \'{}\' not found'.format(image))
 
@@ -95,22 +117,74 @@ class TestDockerEnvironment:
         )
 
     def _create_image(self, image: Dict[str, Any]):
-        return DockerImage(id=image['id'], tags=image['tags'])
+        return DockerImage(id=image['id'], tags=image['tags'], labels=image.get('labels', None))
 
     def _create_container(self, container: Dict[str, Any], images: Dict[str, DockerImage]):
         return DockerContainer(
             id=container['id'], 
             image=images[container['image_id']], 
             status=container['status'],
-            logs=container.get('logs', '')
+            logs=container.get('logs', ''),
+            stats=container.get('stats', None),
+            labels=container.get('labels', None)
         )
 
+class FakeDockerAPI(object):
+    def __init__(self, build_output: List[Dict[str, Any]]):
+        self.build_output = build_output
+
+        self.closed = False
+
+    def build(self, path, tag, **kwargs):
+        try:
+            for chunk in self.build_output:
+                yield chunk
+        finally:
+            self.closed = True
+
 class FakeDockerClient(object):
-    def __init__(self, containers: DockerContainers, images: DockerImages):
+    def __init__(self, containers: DockerContainers, images: DockerImages, api: FakeDockerAPI = None):
         self.containers = containers
         self.images = images
+        self.api = api or FakeDockerAPI([])
+
+    def ping(self):
+        return True
 
 
 def test_docker_client(containers: List[Dict[str, Any]], images: List[Dict[str, Any]]):
     env = TestDockerEnvironment(containers=containers, images=images)
     return env.get_client()
+
+
+def setup_test_db():
+    engine = create_engine('sqlite://', connect_args=dict(check_same_thread=False),
+                           poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    db_session.remove()
+    db_session.configure(bind=engine)
+    return engine
+
+def teardown_test_db(engine):
+    db_session.remove()
+    Base.metadata.drop_all(bind=engine)
+    engine.dispose()
+
+def add_bot_record(bot_name, owner, **fields):
+    bot = Bot(bot_name, owner)
+    for field, value in fields.items():
+        setattr(bot, field, value)
+    bot.version = bump_catalog_version(owner)
+    db_session.add(bot)
+    db_session.commit()
+    return bot
+
+def setup_test_locks_dir():
+    locks_dir = tempfile.TemporaryDirectory()
+    locks_dir_patch = patch('locks.LOCKS_DIR', new=locks_dir.name)
+    locks_dir_patch.start()
+    return locks_dir, locks_dir_patch
+
+def teardown_test_locks_dir(locks_dir, locks_dir_patch):
+    locks_dir_patch.stop()
+    locks_dir.cleanup()